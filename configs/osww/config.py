@@ -5,6 +5,7 @@ from typing import OrderedDict
 import awkward as ak
 import hist
 import numpy as np
+from gen_studies.analysis.kernels import split_particles
 from gen_studies.analysis.utils import flatten_samples, read_ops
 from gen_studies.plot.utils import cmap
 
@@ -46,131 +47,119 @@ def object_definitions(events):
         with_name="Momentum4D",
     )
     Particle = Particle[Particle.status == 1]
-    events["Particle"] = Particle
+
+    # Split the particles by pdgId in a single compiled pass
+    # Jets are everything that is not Lepton or Neutrino
+    collections = split_particles(
+        Particle,
+        {"Neutrino": [12, 14, 16], "Lepton": [11, 13], "Tau": [15]},
+        default="Jet",
+    )
 
     # Define MET
-    neutrinos_gen = events.Particle[
-        (
-            (abs(events.Particle.pdgId) == 12)
-            | (abs(events.Particle.pdgId) == 14)
-            | (abs(events.Particle.pdgId) == 16)
-        )
-    ]
-    # events["MET"] = neutrinos_gen[:, 0] + neutrinos_gen[:, 1]
-    events["MET"] = ak.sum(neutrinos_gen, axis=1)
-
-    # Remove neutrinos from particle
-    events["Particle"] = events.Particle[
-        (
-            (abs(events.Particle.pdgId) != 12)
-            & (abs(events.Particle.pdgId) != 14)
-            & (abs(events.Particle.pdgId) != 16)
-        )
-    ]
+    events["MET"] = ak.sum(collections["Neutrino"], axis=1)
 
     # Define leptons no tau
-    events["Lepton"] = events.Particle[
-        (abs(events.Particle.pdgId) == 11) | (abs(events.Particle.pdgId) == 13)
-    ]
+    events["Lepton"] = collections["Lepton"]
+
+    # Define Jets
+    events["Jet"] = collections["Jet"]
+
     # Remove events where nleptons != 2
     events = events[ak.num(events.Lepton) == 2]
 
-    # Define Jets
-    # Everything that is not Lepton or Neutrino
-    events["Jet"] = events.Particle[
-        (
-            (abs(events.Particle.pdgId) != 11)
-            & (abs(events.Particle.pdgId) != 12)
-            & (abs(events.Particle.pdgId) != 13)
-            & (abs(events.Particle.pdgId) != 14)
-            & (abs(events.Particle.pdgId) != 15)
-            & (abs(events.Particle.pdgId) != 16)
-        )
-    ]
+    # Leading objects and pairs, computed once and shared by variables and regions
+    events["Jet1"] = events.Jet[:, 0]
+    events["Jet2"] = events.Jet[:, 1]
+    events["jj"] = events.Jet1 + events.Jet2
+    events["Lepton1"] = events.Lepton[:, 0]
+    events["Lepton2"] = events.Lepton[:, 1]
+    events["ll"] = events.Lepton1 + events.Lepton2
+
     return events
 
 
 def get_variables():
     return {
         "mjj": {
-            "func": lambda events: (events.Jet[:, 0] + events.Jet[:, 1]).mass,
+            "func": lambda events: events.jj.mass,
             "axis": hist.axis.Regular(15, 500, 3000, name="mjj"),
             "formatted": r"m_{jj} \; [GeV]",
         },
         "mll": {
-            "func": lambda events: (events.Lepton[:, 0] + events.Lepton[:, 1]).mass,
+            "func": lambda events: events.ll.mass,
             "axis": hist.axis.Regular(30, 20, 3000, name="mll"),
             "formatted": r"m_{ll} \; [GeV]",
         },
         "mjj:ptj1": {
-            "func1": lambda events: (events.Jet[:, 0] + events.Jet[:, 1]).mass,
+            "func1": lambda events: events.jj.mass,
             "axis1": hist.axis.Regular(10, 200, 3000, name="mjj"),
-            "func2": lambda events: events.Jet[:, 0].pt,
+            "func2": lambda events: events.Jet1.pt,
             "axis2": hist.axis.Regular(6, 30, 150, name="ptj1"),
             "formatted": r"m_{jj}\,:\,p^T_{j1}",
         },
         "detajj": {
-            "func": lambda events: abs(events.Jet[:, 0].deltaeta(events.Jet[:, 1])),
+            "func": lambda events: abs(events.Jet1.deltaeta(events.Jet2)),
             "axis": hist.axis.Regular(15, 2.5, 8, name="detajj"),
             "formatted": r"\Delta\eta_{jj}",
         },
         "dphijj": {
-            "func": lambda events: abs(events.Jet[:, 0].deltaphi(events.Jet[:, 1])),
+            "func": lambda events: abs(events.Jet1.deltaphi(events.Jet2)),
             "axis": hist.axis.Regular(30, 0, np.pi, name="dphijj"),
             "formatted": r"\Delta\phi_{jj}",
         },
         "ptj1": {
-            "func": lambda events: events.Jet[:, 0].pt,
+            "func": lambda events: events.Jet1.pt,
             "axis": hist.axis.Regular(30, 30, 150, name="ptj1"),
             "formatted": r"p^T_{j1} \; [GeV]",
         },
         "ptj2": {
-            "func": lambda events: events.Jet[:, 1].pt,
+            "func": lambda events: events.Jet2.pt,
             "axis": hist.axis.Regular(30, 30, 150, name="ptj2"),
             "formatted": r"p^T_{j2} \; [GeV]",
         },
         "ptl1": {
-            "func": lambda events: events.Lepton[:, 0].pt,
+            "func": lambda events: events.Lepton1.pt,
             "axis": hist.axis.Regular(30, 25, 150, name="ptl1"),
             "formatted": r"p^T_{l1} \; [GeV]",
         },
         "ptl2": {
-            "func": lambda events: events.Lepton[:, 1].pt,
+            "func": lambda events: events.Lepton2.pt,
             "axis": hist.axis.Regular(30, 20, 150, name="ptl2"),
             "formatted": r"p^T_{l2} \; [GeV]",
         },
         "ptll": {
-            "func": lambda events: (events.Lepton[:, 0] + events.Lepton[:, 1]).pt,
+            "func": lambda events: events.ll.pt,
             "axis": hist.axis.Regular(30, 20, 2000, name="ptll"),
             "formatted": r"p^T_{ll} \; [GeV]",
         },
         "etaj1": {
-            "func": lambda events: events.Jet[:, 0].eta,
+            "func": lambda events: events.Jet1.eta,
             "axis": hist.axis.Regular(30, 0, 5, name="etaj1"),
             "formatted": r"\eta_{j1}",
         },
         "etaj2": {
-            "func": lambda events: events.Jet[:, 1].eta,
+            "func": lambda events: events.Jet2.eta,
             "axis": hist.axis.Regular(30, 0, 5, name="etaj2"),
             "formatted": r"\eta_{j2}",
         },
         "etal1": {
-            "func": lambda events: events.Lepton[:, 0].eta,
+            "func": lambda events: events.Lepton1.eta,
             "axis": hist.axis.Regular(30, 0, 2.5, name="etal1"),
             "formatted": r"\eta_{l1}",
         },
         "etal2": {
-            "func": lambda events: events.Lepton[:, 1].eta,
+            "func": lambda events: events.Lepton2.eta,
             "axis": hist.axis.Regular(30, 0, 2.5, name="etal2"),
             "formatted": r"\eta_{l2}",
         },
         "phij1": {
-            "func": lambda events: events.Jet[:, 0].phi,
+            "func": lambda events: events.Jet1.phi,
             "axis": hist.axis.Regular(30, 0, np.pi, name="phij1"),
             "formatted": r"\phi_{j1}",
         },
         "phij2": {
-            "func": lambda events: events.Jet[:, 1].phi,
+            "func": lambda events: events.Jet2.phi,
             "axis": hist.axis.Regular(30, 0, np.pi, name="phij2"),
             "formatted": r"\phi_{j2}",
         },
@@ -184,7 +173,7 @@ def get_variables():
 def get_regions():
     def sr(events):
         return (
-            ((events.Jet[:, 0].pt > 30.0) & (events.Jet[:, 1].pt > 30.0))
+            ((events.Jet1.pt > 30.0) & (events.Jet2.pt > 30.0))
             & (abs(events.detajj) >= 2.5)
             & (events.mjj >= 500)
             & (events.mll >= 20)
@@ -192,10 +181,10 @@ def get_regions():
             & (events.ptl2 >= 20)
             & (events.ptj1 >= 30)
             & (events.ptj2 >= 30)
-            & (abs(events.Jet[:, 0].eta) < 5)
-            & (abs(events.Jet[:, 1].eta) < 5)
-            & (abs(events.Lepton[:, 0].eta) < 2.5)
-            & (abs(events.Lepton[:, 1].eta) < 2.5)
+            & (abs(events.Jet1.eta) < 5)
+            & (abs(events.Jet2.eta) < 5)
+            & (abs(events.Lepton1.eta) < 2.5)
+            & (abs(events.Lepton2.eta) < 2.5)
         )
 
     return {
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+
+import awkward as ak
+import numpy as np
+from gen_studies.analysis.utils import atomic_path
+
+
+def get_cache_path(cache_dir, filename, treename, start, stop):
+    """
+    Returns the directory where the columns of an entry range of a file
+    are cached. The key depends on the path, mtime and size of the file,
+    so that a modified file is never read from a stale cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        the base directory of the cache
+    filename : str
+        path of the root file
+    treename : str
+        name of the tree
+    start : int
+        first entry
+    stop : int
+        last entry (excluded)
+
+    Returns
+    -------
+    str or None
+        the cache directory for this range, None if the file can not be
+        stat (e.g. remote files)
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = ":".join(
+        [
+            os.path.abspath(filename),
+            str(stat.st_mtime_ns),
+            str(stat.st_size),
+            treename,
+            str(start),
+            str(stop),
+        ]
+    )
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def save_column(cache_path, name, array):
+    """
+    Saves a column as uncompressed npy buffers (see `ak.to_buffers`)
+    in `cache_path/name/`. The directory is written atomically.
+
+    Parameters
+    ----------
+    cache_path : str
+        the cache directory of the range
+    name : str
+        name of the column (branch)
+    array : ak.Array
+        the column
+    """
+    final_path = os.path.join(cache_path, name)
+    if os.path.exists(final_path):
+        return
+    form, length, container = ak.to_buffers(ak.to_packed(array))
+    try:
+        with atomic_path(final_path) as tmp_path:
+            os.makedirs(tmp_path, exist_ok=True)
+            for key, buffer in container.items():
+                np.save(os.path.join(tmp_path, f"{key}.npy"), np.asarray(buffer))
+            with open(os.path.join(tmp_path, "form.json"), "w") as file:
+                json.dump({"form": form.to_dict(), "length": length}, file)
+    except OSError:
+        # the move fails if the column was written by another process
+        if not os.path.exists(os.path.join(final_path, "form.json")):
+            raise
+
+
+def load_column(cache_path, name):
+    """
+    Loads a column saved with `save_column`.
+    The buffers are memory-mapped (read-only) and used directly by the
+    awkward array without copies, so that different processes reading the
+    same column share the page cache.
+
+    Parameters
+    ----------
+    cache_path : str
+        the cache directory of the range
+    name : str
+        name of the column (branch)
+
+    Returns
+    -------
+    ak.Array or None
+        the column, None if it is not in the cache
+    """
+    path = os.path.join(cache_path, name)
+    if not os.path.exists(os.path.join(path, "form.json")):
+        return None
+    with open(os.path.join(path, "form.json")) as file:
+        metadata = json.load(file)
+    form = ak.forms.from_dict(metadata["form"])
+    container = {}
+    for filename in os.listdir(path):
+        if filename.endswith(".npy"):
+            container[filename[: -len(".npy")]] = np.load(
+                os.path.join(path, filename), mmap_mode="r"
+            )
+    return ak.from_buffers(form, metadata["length"], container)
@@ -0,0 +1,320 @@
+import hashlib
+import inspect
+import os
+import pickle
+import re
+
+from gen_studies.analysis.utils import atomic_path, get_variable_keys
+
+
+def get_global_names(code):
+    """
+    Returns the names (globals and attributes) used by a code object and
+    by the functions nested in it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= get_global_names(const)
+    return names
+
+
+def get_value_source(value, module, seen):
+    """
+    Returns a string that identifies a value used by a function of `module`
+    (closure, default or global): the source of the functions defined in
+    the same module (e.g. helpers of the config), the name of modules,
+    classes and other functions, the repr of any other value.
+    """
+    if inspect.ismodule(value):
+        return f"module {value.__name__}"
+    if inspect.isfunction(value) and value.__module__ == module:
+        if id(value) in seen:
+            return f"function {value.__qualname__}"
+        return get_source(value, seen)
+    if callable(value):
+        name = getattr(value, "__qualname__", type(value).__qualname__)
+        return f"callable {getattr(value, '__module__', None)}.{name}"
+    return repr(value)
+
+
+def get_source(func, seen=None):
+    """
+    Returns a string that identifies a function: its source code (or
+    bytecode if the source is not available), the values of its
+    closure and defaults and the globals it uses.
+    Functions defined in the same module that are used as globals (e.g.
+    helpers of the config) are identified by their source, recursively.
+
+    Parameters
+    ----------
+    func : function
+        the function
+    seen : set, optional
+        ids of the functions already visited, by default None
+
+    Returns
+    -------
+    str
+        the identifier of the function
+    """
+    if seen is None:
+        seen = set()
+    seen.add(id(func))
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__
+        source = repr((code.co_code, code.co_consts, code.co_names))
+    module = func.__module__
+    closure = [
+        get_value_source(cell.cell_contents, module, seen)
+        for cell in (func.__closure__ or [])
+    ]
+    defaults = [
+        get_value_source(value, module, seen) for value in (func.__defaults__ or ())
+    ]
+    globals_ = [
+        (name, get_value_source(func.__globals__[name], module, seen))
+        for name in sorted(get_global_names(func.__code__))
+        if name in func.__globals__
+    ]
+    return source + repr(closure) + repr(defaults) + repr(globals_)
+
+
+def get_code_fingerprint(func):
+    """
+    Fingerprints what a function computes: its bytecode, constants and names
+    (recursively for nested functions) and its closure and defaults.
+    Unlike `get_source` it does not depend on where and how the function is
+    written (e.g. the same lambda in two dictionaries has the same
+    fingerprint). Closure values other than numbers and strings are
+    identified by their id, so the fingerprint is only valid while they are
+    alive.
+
+    Parameters
+    ----------
+    func : function
+        the function
+
+    Returns
+    -------
+    str
+        the fingerprint
+    """
+
+    def code_key(code):
+        consts = tuple(
+            code_key(const) if inspect.iscode(const) else repr(const)
+            for const in code.co_consts
+        )
+        return (code.co_code, consts, code.co_names)
+
+    def value_key(value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return repr(value)
+        return ("id", id(value))
+
+    closure = [value_key(cell.cell_contents) for cell in (func.__closure__ or [])]
+    defaults = [value_key(value) for value in (func.__defaults__ or ())]
+    return fingerprint(code_key(func.__code__), closure, defaults)
+
+
+def fingerprint(*objects):
+    return hashlib.sha1(repr(objects).encode()).hexdigest()
+
+
+def get_variable_columns(variable_name):
+    return [column for column, _, _ in get_variable_keys(variable_name)]
+
+
+def get_pair_fingerprints(variables, regions):
+    """
+    Fingerprints each (variable, region) combination from the source and
+    axes of the variable and the source of the region.
+    Variables read as columns by a function (`events.mjj` or
+    `events["mjj"]`, e.g. in a region) are included in its fingerprint
+    through the source of their functions (recursively), not their axes.
+
+    Parameters
+    ----------
+    variables : dict
+        variables dictionary as returned by `get_variables`
+    regions : dict
+        regions dictionary as returned by `get_regions`
+
+    Returns
+    -------
+    dict
+        dictionary {(variable, region): fingerprint}
+    """
+    sources = {}
+    axes = {}
+    for variable_name, variable in variables.items():
+        keys = get_variable_keys(variable_name)
+        funcs = [variable[func_key] for _, func_key, _ in keys]
+        sources[variable_name] = "".join(map(get_source, funcs))
+        axes[variable_name] = [repr(variable[axis_key]) for _, _, axis_key in keys]
+
+    def dependencies(source, exclude):
+        deps = []
+        for variable_name in variables:
+            if variable_name == exclude:
+                continue
+            for column in get_variable_columns(variable_name):
+                column = re.escape(column)
+                if re.search(rf"\.{column}\b|\[\s*[\"']{column}[\"']\s*\]", source):
+                    deps.append(variable_name)
+                    break
+        return deps
+
+    # fingerprints of the functions of the variables and of the variables
+    # they read, the values of a variable do not depend on its axes
+    func_fingerprints = {}
+
+    def func_fingerprint(variable_name, visiting=()):
+        if variable_name in func_fingerprints:
+            return func_fingerprints[variable_name]
+        if variable_name in visiting:
+            return variable_name
+        source = sources[variable_name]
+        func_fingerprints[variable_name] = fingerprint(
+            source,
+            [
+                func_fingerprint(dep, visiting + (variable_name,))
+                for dep in dependencies(source, variable_name)
+            ],
+        )
+        return func_fingerprints[variable_name]
+
+    variable_fingerprints = {
+        variable_name: fingerprint(func_fingerprint(variable_name), axes[variable_name])
+        for variable_name in variables
+    }
+    region_fingerprints = {}
+    for region_name in regions:
+        source = get_source(regions[region_name])
+        region_fingerprints[region_name] = fingerprint(
+            source, [func_fingerprint(dep) for dep in dependencies(source, None)]
+        )
+
+    return {
+        (variable_name, region_name): fingerprint(
+            variable_fingerprints[variable_name], region_fingerprints[region_name]
+        )
+        for variable_name in variables
+        for region_name in regions
+    }
+
+
+def get_chunk_fingerprint(
+    chunk, sample_name, branches, object_definitions, variations, eft
+):
+    """
+    Fingerprints everything but variables and regions that determines the
+    histograms of a chunk: the files (path, mtime, size) and entry ranges,
+    the branches, the object definitions, the variations and the eft
+    reweights.
+
+    Parameters
+    ----------
+    chunk : dict
+        chunk dictionary, see `read_events`
+    sample_name : str
+        name of the sample
+    branches : list
+        list of branches
+    object_definitions : function
+        the object definitions function
+    variations : dict
+        variations dictionary as returned by `get_variations`
+    eft : dict
+        dictionary with the "ops", "rwgts", "components" and "matrix" of the
+        sample (empty if no eft)
+
+    Returns
+    -------
+    str
+        the fingerprint
+    """
+    if "ranges" in chunk:
+        ranges = chunk["ranges"]
+    elif "files" in chunk:
+        ranges = [{"file": filename} for filename in chunk["files"]]
+    else:
+        ranges = [chunk]
+    files = []
+    for _range in ranges:
+        stat = os.stat(_range["file"])
+        files.append(
+            (
+                os.path.abspath(_range["file"]),
+                stat.st_mtime_ns,
+                stat.st_size,
+                _range.get("start"),
+                _range.get("stop"),
+            )
+        )
+    _variations = [
+        (
+            variation_name,
+            variation["switches"],
+            sorted(variation["samples"]),
+            get_source(variation["func"]),
+        )
+        for variation_name, variation in variations.items()
+    ]
+    return fingerprint(
+        files,
+        chunk.get("tree", "Events"),
+        sample_name,
+        sorted(branches),
+        get_source(object_definitions),
+        _variations,
+        eft,
+    )
+
+
+def get_partials_path(partials_dir, sample_name, chunk_fingerprint):
+    return os.path.join(partials_dir, sample_name, f"{chunk_fingerprint}.pkl")
+
+
+def load_partials(path):
+    """
+    Loads the partial histograms of a chunk.
+
+    Parameters
+    ----------
+    path : str
+        path of the partials file
+
+    Returns
+    -------
+    dict
+        dictionary with keys "nevents", "sumw" and "histos", where histos is
+        {(variable, region): (fingerprint, array)}, empty if not found
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except Exception as e:
+        print("Could not read partials", path, e)
+        return {}
+
+
+def save_partials(path, partials):
+    """
+    Saves atomically the partial histograms of a chunk.
+
+    Parameters
+    ----------
+    path : str
+        path of the partials file
+    partials : dict
+        dictionary as returned by `load_partials`
+    """
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as file:
+            pickle.dump(partials, file, protocol=pickle.HIGHEST_PROTOCOL)
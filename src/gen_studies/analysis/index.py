@@ -0,0 +1,161 @@
+import glob
+import json
+import os
+
+import uproot
+from gen_studies.analysis.utils import atomic_path
+
+
+def load_index(path):
+    """
+    Loads the file-metadata index from disk.
+
+    Parameters
+    ----------
+    path : str
+        path of the json index
+
+    Returns
+    -------
+    dict
+        the index, empty if the file does not exist or can not be parsed
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        print("Could not read files index", path, "will rebuild it")
+        return {}
+
+
+def save_index(index, path):
+    """
+    Saves atomically the file-metadata index on disk.
+
+    Parameters
+    ----------
+    index : dict
+        the index
+    path : str
+        path of the json index
+    """
+    if path is None:
+        return
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "w") as file:
+            json.dump(index, file)
+
+
+def get_pattern_dirs(files_pattern):
+    """
+    Returns the directories whose content determines the result of
+    `glob.glob(files_pattern)`.
+
+    Parameters
+    ----------
+    files_pattern : str
+        glob pattern
+
+    Returns
+    -------
+    list
+        list of directories
+    """
+    dirname = os.path.dirname(files_pattern) or "."
+    if glob.escape(dirname) == dirname:
+        return [dirname]
+    return get_pattern_dirs(dirname) + glob.glob(dirname)
+
+
+def get_dirs_mtime(dirs):
+    """
+    Returns the mtime (in ns) of each directory, None if it does not exist.
+    """
+    dirs_mtime = {}
+    for dirname in dirs:
+        try:
+            dirs_mtime[dirname] = os.stat(dirname).st_mtime_ns
+        except OSError:
+            dirs_mtime[dirname] = None
+    return dirs_mtime
+
+
+def get_sample_files(index, sample_name, files_pattern):
+    """
+    Returns the files matching the pattern of a sample.
+    The glob is skipped if none of the directories scanned by the pattern
+    changed (mtime) since the last time it was cached in the index.
+
+    Parameters
+    ----------
+    index : dict
+        the index, will be updated in place
+    sample_name : str
+        name of the sample
+    files_pattern : str
+        glob pattern of the files of the sample
+
+    Returns
+    -------
+    list
+        list of files
+    """
+    sample_index = index.setdefault("samples", {}).get(sample_name, {})
+    if sample_index.get("files_pattern") == files_pattern:
+        dirs_mtime = sample_index["dirs"]
+        if get_dirs_mtime(dirs_mtime) == dirs_mtime:
+            return sample_index["files"]
+
+    files = glob.glob(files_pattern)
+    index["samples"][sample_name] = {
+        "files_pattern": files_pattern,
+        "dirs": get_dirs_mtime(get_pattern_dirs(files_pattern)),
+        "files": files,
+    }
+    return files
+
+
+def get_files_metadata(index, files, treename="Events"):
+    """
+    Returns the number of entries and the list of branches of each file.
+    Files are opened only if they are not in the index or if their
+    size or mtime changed.
+
+    Parameters
+    ----------
+    index : dict
+        the index, will be updated in place
+    files : list
+        list of root files
+    treename : str, optional
+        name of the tree, by default "Events"
+
+    Returns
+    -------
+    list
+        list of dictionaries with keys "entries" and "branches", one for each
+        file
+    """
+    files_index = index.setdefault("files", {})
+    metadata = []
+    for filename in files:
+        stat = os.stat(filename)
+        key = f"{filename}:{treename}"
+        file_index = files_index.get(key, {})
+        if (
+            file_index.get("mtime") != stat.st_mtime_ns
+            or file_index.get("size") != stat.st_size
+        ):
+            with uproot.open(filename) as file:
+                tree = file[treename]
+                file_index = {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "entries": tree.num_entries,
+                    "branches": tree.keys(),
+                }
+            files_index[key] = file_index
+        metadata.append(file_index)
+    return metadata
@@ -0,0 +1,190 @@
+import awkward as ak
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def _classify(counts, pdgId, table, ncollections):
+    nevents = len(counts)
+    collection_counts = np.zeros((ncollections, nevents), dtype=np.int64)
+    codes = np.empty(len(pdgId), dtype=np.int64)
+    i = 0
+    for event in range(nevents):
+        for _ in range(counts[event]):
+            pdg = abs(pdgId[i])
+            if pdg < len(table) - 1:
+                code = table[pdg]
+            else:
+                code = table[-1]
+            codes[i] = code
+            if code >= 0:
+                collection_counts[code, event] += 1
+            i += 1
+
+    # counting sort: group the particles by collection keeping the event order
+    starts = np.zeros(ncollections + 1, dtype=np.int64)
+    for code in range(ncollections):
+        starts[code + 1] = starts[code] + collection_counts[code].sum()
+    index = np.empty(starts[-1], dtype=np.int64)
+    position = starts[:-1].copy()
+    for i in range(len(codes)):
+        code = codes[i]
+        if code >= 0:
+            index[position[code]] = i
+            position[code] += 1
+    return index, starts, collection_counts
+
+
+def classify_pdgId(counts, pdgId, collections, default=None):
+    """
+    Classifies the particles by pdgId in a single compiled pass.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        number of particles of each event
+    pdgId : np.ndarray
+        flat pdgId of all the particles
+    collections : dict
+        dictionary {collection name: list of pdgIds}, the sign of the pdgIds
+        is ignored and each pdgId should appear in only one collection
+    default : str, optional
+        name of the collection of the particles with any other pdgId,
+        by default None (they are dropped)
+
+    Returns
+    -------
+    dict
+        dictionary {collection name: (index, counts)} where index are the
+        positions in the flat arrays of the particles of the collection
+        (in event order) and counts the number of particles in each event
+    """
+    names = list(collections)
+    if default is not None:
+        names.append(default)
+    max_pdgId = max([abs(pdg) for pdgs in collections.values() for pdg in pdgs] + [0])
+    # last entry is the code of all the pdgIds not in the table
+    table = np.full(max_pdgId + 2, -1, dtype=np.int64)
+    if default is not None:
+        table[:] = len(names) - 1
+    for code, name in enumerate(collections):
+        for pdg in collections[name]:
+            table[abs(pdg)] = code
+
+    index, starts, collection_counts = _classify(
+        np.asarray(counts, dtype=np.int64),
+        np.asarray(pdgId),
+        table,
+        len(names),
+    )
+    return {
+        name: (index[starts[code] : starts[code + 1]], collection_counts[code])
+        for code, name in enumerate(names)
+    }
+
+
+def split_particles(particles, collections, default=None):
+    """
+    Splits the particles in collections according to their pdgId, replacing
+    one jagged mask on `abs(particles.pdgId)` for each collection with a
+    single compiled pass (see `classify_pdgId`).
+
+    Parameters
+    ----------
+    particles : ak.Array
+        jagged array of particles with a pdgId field
+    collections : dict
+        dictionary {collection name: list of pdgIds}
+    default : str, optional
+        name of the collection of the particles with any other pdgId,
+        by default None (they are dropped)
+
+    Returns
+    -------
+    dict
+        dictionary {collection name: jagged array of particles}, particles
+        keep their original order within each event
+
+    Examples
+    --------
+    >>> collections = split_particles(
+    ...     events.Particle,
+    ...     {"Neutrino": [12, 14, 16], "Lepton": [11, 13], "Tau": [15]},
+    ...     default="Jet",
+    ... )
+    >>> events["Jet"] = collections["Jet"]
+    """
+    if ak.backend(particles) == "typetracer":
+        # tracing the branches (see `get_touched_branches`): same type
+        ak.typetracer.touch_data(particles.pdgId)
+        names = list(collections) + ([default] if default is not None else [])
+        return {name: particles for name in names}
+    counts = ak.to_numpy(ak.num(particles, axis=1))
+    flat = ak.flatten(particles, axis=1)
+    classified = classify_pdgId(counts, ak.to_numpy(flat.pdgId), collections, default)
+    return {
+        name: ak.unflatten(flat[index], collection_counts)
+        for name, (index, collection_counts) in classified.items()
+    }
+
+
+@numba.njit(cache=True)
+def _leading_pair(counts, pt, by_pt):
+    nevents = len(counts)
+    first = np.full(nevents, -1, dtype=np.int64)
+    second = np.full(nevents, -1, dtype=np.int64)
+    start = 0
+    for event in range(nevents):
+        for i in range(start, start + counts[event]):
+            if first[event] < 0:
+                first[event] = i
+            elif by_pt and pt[i] > pt[first[event]]:
+                second[event] = first[event]
+                first[event] = i
+            elif second[event] < 0 or (by_pt and pt[i] > pt[second[event]]):
+                second[event] = i
+        start += counts[event]
+    return first, second
+
+
+def leading_pair(collection, by_pt=False):
+    """
+    Returns the leading and subleading objects of each event in a single
+    compiled pass.
+
+    Parameters
+    ----------
+    collection : ak.Array
+        jagged array of objects (with a pt field if by_pt)
+    by_pt : bool, optional
+        if True the objects with the highest pt are taken, otherwise the
+        first two of each event (as `collection[:, 0]` and `collection[:, 1]`),
+        by default False
+
+    Returns
+    -------
+    tuple
+        the leading and subleading objects, None for the events with less
+        than one or two objects
+    """
+    if ak.backend(collection) == "typetracer":
+        # tracing the branches (see `get_touched_branches`): same type
+        if by_pt:
+            ak.typetracer.touch_data(collection.pt)
+        return ak.firsts(collection, axis=1), ak.firsts(collection[:, 1:], axis=1)
+    counts = ak.to_numpy(ak.num(collection, axis=1))
+    flat = ak.flatten(collection, axis=1)
+    if by_pt:
+        pt = ak.to_numpy(flat.pt)
+    else:
+        pt = np.zeros(0)
+    first, second = _leading_pair(counts, pt, by_pt)
+    return tuple(
+        ak.Array(
+            ak.contents.IndexedOptionArray.simplified(
+                ak.index.Index64(index), flat.layout
+            ),
+            behavior=flat.behavior,
+        )
+        for index in (first, second)
+    )
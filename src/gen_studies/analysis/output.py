@@ -0,0 +1,278 @@
+import json
+import os
+import struct
+
+import hist
+import numpy as np
+import uproot
+from gen_studies.analysis.utils import atomic_path
+
+
+def get_compression(compression):
+    """
+    Parses the compression setting of the output file.
+
+    Parameters
+    ----------
+    compression : str or None
+        "ALGORITHM:level" with algorithm one of ZLIB, LZMA, LZ4 and ZSTD
+        (e.g. "ZLIB:1", "LZ4:4"), None for no compression
+
+    Returns
+    -------
+    uproot.compression.Compression or None
+        the compression for uproot
+    """
+    if compression is None:
+        return None
+    algorithm, level = compression.split(":")
+    return getattr(uproot.compression, algorithm.upper())(int(level))
+
+
+def write_histos(path, histos, compression="ZLIB:1"):
+    """
+    Writes the histograms in a new root file with one bulk update for each
+    directory, instead of one serialization and TKey update for each
+    histogram.
+
+    Parameters
+    ----------
+    path : str
+        path of the root file, will be overwritten
+    histos : dict
+        dictionary {"dir/subdir/name": histogram}
+    compression : str or None, optional
+        compression of the file, see `get_compression`, by default "ZLIB:1"
+    """
+    directories = {}
+    for final_name, h in histos.items():
+        directory, _, name = final_name.rpartition("/")
+        directories.setdefault(directory, {})[name] = h
+
+    with uproot.recreate(path, compression=get_compression(compression)) as out:
+        for directory, directory_histos in directories.items():
+            if directory == "":
+                out.update(directory_histos)
+            else:
+                out.mkdir(directory).update(directory_histos)
+
+
+ARCHIVE_MAGIC = b"GSHISTO1"
+# the data of the archive starts at a multiple of this (in bytes)
+ARCHIVE_ALIGN = 64
+
+
+def get_axis_description(axis, edges_offsets, buffers, offset):
+    """
+    Describes an axis for the archive index, the edges are stored only once
+    for all the axes with the same binning.
+
+    Returns
+    -------
+    tuple
+        the description and the new offset of the data buffer
+    """
+    edges = np.ascontiguousarray(axis.edges, dtype="<f8")
+    key = edges.tobytes()
+    if key not in edges_offsets:
+        edges_offsets[key] = offset
+        buffers.append(edges)
+        offset += len(edges)
+    description = {
+        "edges": [edges_offsets[key], len(edges)],
+        "regular": isinstance(axis, hist.axis.Regular),
+        "underflow": bool(axis.traits.underflow),
+        "overflow": bool(axis.traits.overflow),
+        "name": axis.name,
+        "label": axis.label,
+    }
+    return description, offset
+
+
+def write_archive(path, histos):
+    """
+    Writes the histograms in a single dense archive that can be memory
+    mapped, see `HistosArchive`.
+    The file is made of a magic string, the length of a json index
+    {name: {"offset", "shape", "axes"}} and the index, followed by one
+    float64 buffer with the values and the variances (with flow) of each
+    histogram and the edges of the axes.
+
+    Parameters
+    ----------
+    path : str
+        path of the archive, will be overwritten
+    histos : dict
+        dictionary {"dir/subdir/name": histogram}
+    """
+    index = {}
+    edges_offsets = {}
+    buffers = []
+    offset = 0
+    for final_name, h in histos.items():
+        values = np.ascontiguousarray(h.values(flow=True), dtype="<f8")
+        variances = np.ascontiguousarray(h.variances(flow=True), dtype="<f8")
+        entry = {"offset": offset, "shape": list(values.shape), "axes": []}
+        buffers.extend([values, variances])
+        offset += 2 * values.size
+        for axis in h.axes:
+            description, offset = get_axis_description(
+                axis, edges_offsets, buffers, offset
+            )
+            entry["axes"].append(description)
+        index[final_name] = entry
+
+    header = json.dumps(index).encode()
+    data_start = len(ARCHIVE_MAGIC) + 8 + len(header)
+    padding = -data_start % ARCHIVE_ALIGN
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as file:
+            file.write(ARCHIVE_MAGIC)
+            file.write(struct.pack("<Q", len(header) + padding))
+            file.write(header + b" " * padding)
+            for buffer in buffers:
+                buffer.tofile(file)
+
+
+class ArchivedHisto:
+    """
+    A histogram of a `HistosArchive`, its values and variances are views of
+    the memory mapped archive.
+    Mimics the methods of the histograms read with uproot used by the plot
+    and fit scripts.
+    """
+
+    def __init__(self, data, entry):
+        self._data = data
+        self._entry = entry
+
+    def _flow_slice(self, flow):
+        if flow:
+            return ...
+        return tuple(
+            slice(
+                1 if axis["underflow"] else 0,
+                -1 if axis["overflow"] else None,
+            )
+            for axis in self._entry["axes"]
+        )
+
+    def values(self, flow=False):
+        shape = self._entry["shape"]
+        start = self._entry["offset"]
+        size = int(np.prod(shape))
+        return self._data[start : start + size].reshape(shape)[self._flow_slice(flow)]
+
+    def variances(self, flow=False):
+        shape = self._entry["shape"]
+        size = int(np.prod(shape))
+        start = self._entry["offset"] + size
+        return self._data[start : start + size].reshape(shape)[self._flow_slice(flow)]
+
+    def edges(self, axis=0):
+        start, length = self._entry["axes"][axis]["edges"]
+        return self._data[start : start + length]
+
+    def to_hist(self):
+        """
+        Returns
+        -------
+        hist.Hist
+            a new histogram with Weight storage (copy of the archived data)
+        """
+        axes = []
+        for iaxis, axis in enumerate(self._entry["axes"]):
+            edges = self.edges(iaxis)
+            options = dict(
+                underflow=axis["underflow"],
+                overflow=axis["overflow"],
+                name=axis["name"],
+                label=axis["label"],
+            )
+            if axis["regular"]:
+                axes.append(
+                    hist.axis.Regular(len(edges) - 1, edges[0], edges[-1], **options)
+                )
+            else:
+                axes.append(hist.axis.Variable(np.array(edges), **options))
+        h = hist.Hist(*axes, storage=hist.storage.Weight())
+        view = h.view(True)
+        view.value = self.values(flow=True)
+        view.variance = self.variances(flow=True)
+        return h
+
+
+class HistosArchive:
+    """
+    Reader of the archive written by `write_archive`.
+    Only the json index is parsed when opening, the data is memory mapped and
+    each histogram is a slice of it: accessing one histogram does not read
+    or deserialize the others.
+
+    Parameters
+    ----------
+    path : str
+        path of the archive
+
+    Examples
+    --------
+    >>> archive = HistosArchive("histos.gsa")
+    >>> archive["sr/mjj/histo_OSWW_sm"].values()
+    >>> h = archive["sr/mjj/histo_OSWW_sm"].to_hist()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            if file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise Exception(f"{path} is not a histograms archive")
+            (header_length,) = struct.unpack("<Q", file.read(8))
+            self.index = json.loads(file.read(header_length))
+        data_start = len(ARCHIVE_MAGIC) + 8 + header_length
+        if os.path.getsize(path) > data_start:
+            self._data = np.memmap(path, dtype="<f8", mode="r", offset=data_start)
+        else:
+            self._data = np.zeros(0)
+
+    def __getstate__(self):
+        # reopen (and map again) the archive when sent to other processes
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __getitem__(self, name):
+        return ArchivedHisto(self._data, self.index[name])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+def open_histos(path="histos.root", archive=None):
+    """
+    Opens the histograms written by `gs-analysis-run`, from the archive if
+    it was written (see `write_archive`) otherwise from the root file.
+    In both cases `file["dir/subdir/name"]` has `values()`, `variances()`
+    and `to_hist()`.
+
+    Parameters
+    ----------
+    path : str, optional
+        path of the root file, by default "histos.root"
+    archive : str or None, optional
+        path of the archive, by default None
+
+    Returns
+    -------
+    HistosArchive or uproot.ReadOnlyDirectory
+        the opened histograms
+    """
+    if archive is not None and os.path.exists(archive):
+        return HistosArchive(archive)
+    return uproot.open(path)
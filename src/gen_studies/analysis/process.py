@@ -1,9 +1,82 @@
+import concurrent.futures
 import gc
 
 import awkward as ak
 import hist
+import numpy as np
 import uproot
-from gen_studies.analysis.utils import create_components
+from gen_studies.analysis.cache import get_cache_path, load_column, save_column
+from gen_studies.analysis.incremental import (
+    get_chunk_fingerprint,
+    get_code_fingerprint,
+    get_pair_fingerprints,
+    get_partials_path,
+    load_partials,
+    save_partials,
+)
+from gen_studies.analysis.utils import (
+    add_dict_iterable,
+    create_components,
+    get_components,
+    get_variable_keys,
+    get_weight_source,
+    hist_bin_index,
+    hist_fill_weights,
+)
+
+
+# thread pools of this process, reused by all the chunks
+_executors = {}
+
+
+def get_executor(kind, num_threads):
+    """
+    Returns the thread pool of this process for `kind` ("decompression" or
+    "interpretation") with `num_threads` threads, created the first time.
+    """
+    if (kind, num_threads) not in _executors:
+        _executors[(kind, num_threads)] = concurrent.futures.ThreadPoolExecutor(
+            num_threads
+        )
+    return _executors[(kind, num_threads)]
+
+
+def prefetch_events(chunks, branches):
+    """
+    Yields each chunk together with a future of its events: the events of
+    the next chunk are read in a background thread while the current one is
+    processed.
+    Chunks with "prefetch" False or with a "partials_dir" (that might not
+    need to be read at all) are not prefetched and the future is None.
+
+    Parameters
+    ----------
+    chunks : list
+        list of chunk dictionaries, see `read_events`
+    branches : list
+        list of branches to read
+
+    Yields
+    ------
+    tuple
+        (chunk, concurrent.futures.Future or None)
+    """
+
+    def submit(reader, chunk):
+        if not chunk.get("prefetch", True) or chunk.get("partials_dir") is not None:
+            return None
+        return reader.submit(read_events, chunk, branches)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as reader:
+        future = None
+        for ichunk, chunk in enumerate(chunks):
+            if future is None:
+                future = submit(reader, chunk)
+            next_future = None
+            if ichunk + 1 < len(chunks):
+                next_future = submit(reader, chunks[ichunk + 1])
+            yield chunk, future
+            future = next_future
 
 
 def read_events(chunk, branches):
@@ -30,6 +103,31 @@ def read_events(chunk, branches):
             "interpretation_executor": (uproot.source.
                                       futures.TrivialExecutor()),
         },
+        "cache_dir": "/tmp/gen_studies_cache",  # optional, default None
+        "num_threads": 4,  # optional, default 1
+    }
+    ```
+
+    If "num_threads" is greater than 1 the baskets are decompressed and
+    interpreted by thread pools of that size (unless executors are given in
+    "arrays_options").
+
+    If "cache_dir" is provided the decompressed branches are cached there
+    as uncompressed buffers (one directory per file range and branch) and
+    read from the cache in the following runs.
+
+    If key "ranges" is in chunk: read each range as a single file chunk
+    (with the other keys of chunk, e.g. "tree" and "open_options")
+    and concatenate them
+    ```python
+    {
+        "ranges": [
+            {"file": "/gwteras/cms/store/user/nanoAOD_100.root",
+             "start": 4000, "stop": 5000},
+            {"file": "/gwteras/cms/store/user/nanoAOD_101.root",
+             "start": 0, "stop": 3000},
+        ],
+        "open_options": {"num_workers": 2},  # optional dict
     }
     ```
 
@@ -46,41 +144,282 @@ def read_events(chunk, branches):
     events: ak.Array
         the events read from file(s)
     """
+    arrays_options = dict(chunk.get("arrays_options", {}))
+    num_threads = chunk.get("num_threads", 1)
+    if num_threads > 1:
+        arrays_options.setdefault(
+            "decompression_executor", get_executor("decompression", num_threads)
+        )
+        arrays_options.setdefault(
+            "interpretation_executor", get_executor("interpretation", num_threads)
+        )
+
     if "files" in chunk:
-        return uproot.concatenate(**chunk, filter_name=branches)
+        return uproot.concatenate(
+            chunk["files"], filter_name=branches, **arrays_options
+        )
     elif "file" in chunk:
-        filename = chunk.pop("file")
+        filename = chunk["file"]
         treename = chunk.get("tree", "Events")
-        start = chunk.pop("start")
-        stop = chunk.pop("stop")
+        start = chunk["start"]
+        stop = chunk["stop"]
+
+        cache_path = None
+        if chunk.get("cache_dir") is not None:
+            cache_path = get_cache_path(
+                chunk["cache_dir"], filename, treename, start, stop
+            )
+        columns = {}
+        if cache_path is not None:
+            for branch in branches:
+                column = load_column(cache_path, branch)
+                if column is not None:
+                    columns[branch] = column
+        missing_branches = [branch for branch in branches if branch not in columns]
+        if len(missing_branches) == 0:
+            return ak.zip(columns, depth_limit=1)
+
         file = uproot.open(
             filename,
             **chunk.get("open_options", {}),
         )
         events = file[treename].arrays(
-            filter_name=branches,
+            filter_name=missing_branches,
             entry_start=start,
             entry_stop=stop,
-            **chunk.get("arrays_options", {}),
+            **arrays_options,
         )
         file.close()
-        return events
+        if cache_path is None:
+            return events
+
+        for branch in events.fields:
+            save_column(cache_path, branch, events[branch])
+            columns[branch] = events[branch]
+        return ak.zip(columns, depth_limit=1)
+    elif "ranges" in chunk:
+        options = {k: v for k, v in chunk.items() if k != "ranges"}
+        return ak.concatenate(
+            [read_events({**options, **_range}, branches) for _range in chunk["ranges"]]
+        )
     else:
-        raise Exception('Could not parse chunk, "files" nor "file" found', chunk)
+        raise Exception(
+            'Could not parse chunk, "files" nor "file" nor "ranges" found', chunk
+        )
 
 
-def process(
+class EventColumns:
+    """
+    The events of a chunk together with a side table of flat columns.
+
+    Derived variables, region masks and weights are stored as contiguous
+    numpy arrays in the side table instead of fields of the event record,
+    which is never rebuilt nor sliced to fill the histograms.
+    Reading a name (as item or attribute) looks it up in the side table
+    first and then in the events, so the functions of the config see a
+    single events-like object. Indexing with a mask, a slice or an index
+    array returns a new `EventColumns` with the events and the side table
+    sliced in the same way.
+
+    Parameters
+    ----------
+    events : ak.Array
+        the events
+    columns : dict, optional
+        the side table {name: array}, by default empty
+    """
+
+    def __init__(self, events, columns=None):
+        self._events = events
+        self._columns = {} if columns is None else columns
+
+    def __len__(self):
+        return len(self._events)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self._columns:
+                return self._columns[key]
+            return self._events[key]
+        if isinstance(key, (int, np.integer)):
+            raise IndexError(
+                "EventColumns can be sliced with masks, slices or index arrays, "
+                "not indexed by a single event"
+            )
+        return EventColumns(
+            self._events[key],
+            {name: column[key] for name, column in self._columns.items()},
+        )
+
+    def __getattr__(self, name):
+        if name in ["_events", "_columns"] or name.startswith("__"):
+            raise AttributeError(name)
+        if name in self._columns:
+            return self._columns[name]
+        return getattr(self._events, name)
+
+    def __setitem__(self, name, value):
+        # flat awkward arrays without records are stored as numpy arrays
+        if isinstance(value, ak.Array) and value.ndim == 1 and not value.fields:
+            try:
+                value = ak.to_numpy(value, allow_missing=False)
+            except ValueError:
+                pass
+        self._columns[name] = value
+
+
+def get_column_numpy(events, name):
+    """
+    Returns a column of the side table (or field of the events) of an
+    `EventColumns` as a numpy array.
+    """
+    value = events[name]
+    if isinstance(value, ak.Array):
+        return ak.to_numpy(value)
+    return np.asarray(value)
+
+
+def get_region_index(events, region_indices, region_column):
+    """
+    Returns (region_column, indices of the selected events), the indices are
+    computed from the mask only the first time and cached in `region_indices`.
+    """
+    if region_column not in region_indices:
+        region_indices[region_column] = np.flatnonzero(
+            get_column_numpy(events, region_column)
+        )
+    return region_column, region_indices[region_column]
+
+
+def fill_histos(
+    histos, variables, events, weights, categories, index, switches={}, bins=None
+):
+    """
+    Fills all the histograms with many sets of weights at once.
+
+    The values of each variable are gathered and binned only once for each
+    set of events (`index`) and every row of `weights` is accumulated in the
+    bins of the corresponding categories.
+
+    Parameters
+    ----------
+    histos : dict
+        dictionary of histograms, one per variable
+    variables : dict
+        variables dictionary as returned by `get_variables`
+    events : EventColumns
+        the events with a column for each variable
+    weights : list
+        list of weight arrays (already indexed), one for each entry of
+        `categories`
+    categories : list
+        list of tuples of indices (variation, region, component)
+    index : tuple
+        (key, np.ndarray) with a name and the indices of the events to fill
+    switches : dict, optional
+        dictionary {column: column to use instead}, by default {}
+    bins : dict, optional
+        cache of the bin indices of each variable, shared by the calls with
+        the same index, by default None (not shared)
+    """
+    if len(weights) == 0:
+        return
+    if bins is None:
+        bins = {}
+    index_key, index = index
+    weights = np.stack(weights).astype(np.float64)
+    for variable_name in variables:
+        h = histos[variable_name]
+        names = [column for column, _, _ in get_variable_keys(variable_name)]
+        columns = tuple(switches.get(name, name) for name in names)
+        key = (index_key, columns)
+        if key not in bins:
+            bins[key] = hist_bin_index(
+                h.axes[-len(names) :],
+                [get_column_numpy(events, column)[index] for column in columns],
+            )
+        hist_fill_weights(h, bins[key], weights, categories)
+
+
+def create_histos(variables, nvariations, nregions, ncomponents):
+    """
+    Creates the empty histograms, one for each variable.
+    Variations, regions and components are known in advance: use dense
+    integer categories indexed as in get_variations(), get_regions()
+    and get_components(), followed by the variable axes.
+    The variable axes must have fixed bins (no growth).
+
+    Parameters
+    ----------
+    variables : dict
+        variables dictionary as returned by `get_variables`
+    nvariations : int
+        number of variations
+    nregions : int
+        number of regions
+    ncomponents : int
+        number of components
+
+    Returns
+    -------
+    dict
+        dictionary of histograms
+    """
+    histos = {}
+    for variable_name in variables:
+        default_axes = [
+            hist.axis.IntCategory(range(nvariations), name="variation", overflow=False),
+            hist.axis.IntCategory(range(nregions), name="region", overflow=False),
+            hist.axis.IntCategory(range(ncomponents), name="component", overflow=False),
+        ]
+        variable_axes = [
+            variables[variable_name][axis_key]
+            for _, _, axis_key in get_variable_keys(variable_name)
+        ]
+        for axis in variable_axes:
+            if axis.traits.growth:
+                # the histograms are filled from precomputed bin indices
+                # (see `hist_bin_index`) in a fixed bin layout
+                raise Exception(
+                    f"Axis {axis!r} of variable {variable_name} has growth=True, "
+                    "growing axes are not supported: use fixed bins"
+                )
+        histos[variable_name] = hist.Hist(
+            *default_axes,
+            *variable_axes,
+            hist.storage.Weight(),
+        )
+    return histos
+
+
+def process_events(
     chunk,
     sample_name,
     branches,
     object_definitions,
-    get_variables,
-    # selections,
-    get_regions,
-    get_variations,
-    eft={},
+    variables,
+    regions,
+    variations,
+    components,
+    eft,
+    histos,
+    pairs,
+    events=None,
 ):
-    events = read_events(chunk, branches)
+    """
+    Reads the events of a chunk (unless a future of the events is given,
+    see `prefetch_events`) and fills the histograms only for the requested
+    (variable, region) pairs.
+
+    Returns
+    -------
+    tuple or None
+        (nevents, sumw) or None if the chunk could not be processed
+    """
+    if events is not None:
+        events = events.result()
+    else:
+        events = read_events(chunk, branches)
 
     if eft:
         rwgts = eft["rwgts"]
@@ -95,98 +434,301 @@ def process(
                 "got",
                 nReweights[nReweights != len(rwgts)],
             )
-            return {}
+            return None
 
     nevents = len(events)
     sumw = ak.sum(events.genWeight)
 
     if eft:
-        events = create_components(events, ops, rwgts)
+        events = create_components(events, ops, rwgts, eft.get("matrix"))
     else:
-        events["components"] = ak.zip({"sm": ak.ones_like(events.genWeight)})
+        events["components"] = np.ones((len(events), 1))
 
     # Define the Physical objects you want to work with
     events = object_definitions(events)
 
-    # variable definitions
-    variables = get_variables()
-    for variable_name in variables:
-        if ":" in variable_name:
-            variable_name1, variable_name2 = variable_name.split(":")
-            events[variable_name1] = variables[variable_name]["func1"](events)
-            events[variable_name2] = variables[variable_name]["func2"](events)
-        else:
-            events[variable_name] = variables[variable_name]["func"](events)
-
-    # Create histograms
-    histos = {}
+    # Derived variables, region masks and weights are stored in a side table
+    # of flat columns, the event record is not modified anymore
+    events = EventColumns(events)
+    component_weights = get_column_numpy(events, "components")
+
+    # variable definitions, each distinct function is evaluated once per
+    # chunk (e.g. the components of 2D variables that are also 1D variables)
+    values = {}
     for variable_name in variables:
-        default_axes = [
-            hist.axis.StrCategory([], name="variation", growth=True),
-            hist.axis.StrCategory([], name="region", growth=True),
-            hist.axis.StrCategory([], name="component", growth=True),
-            hist.storage.Weight(),
-        ]
+        for column, func_name, _ in get_variable_keys(variable_name):
+            func = variables[variable_name][func_name]
+            key = get_code_fingerprint(func)
+            if key not in values:
+                values[key] = func(events)
+            events[column] = values[key]
+    del values
 
-        if ":" in variable_name:
-            variable_name1, variable_name2 = variable_name.split(":")
-            histos[variable_name] = hist.Hist(
-                variables[variable_name]["axis1"],
-                variables[variable_name]["axis2"],
-                *default_axes,
-            )
-        else:
-            histos[variable_name] = hist.Hist(
-                variables[variable_name]["axis"], *default_axes
-            )
+    variation_index = {name: i for i, name in enumerate(variations)}
+    # variables to fill in each region
+    region_variables = {
+        region_name: {
+            variable_name: variables[variable_name]
+            for variable_name in variables
+            if (variable_name, region_name) in pairs
+        }
+        for region_name in regions
+    }
 
     # Select events
-    regions = get_regions()
     for region_name in regions:
         events[region_name] = regions[region_name](events)
 
-    variations = get_variations()
     for variation_name in variations:
         events = variations[variation_name]["func"](events)
 
-    originalEvents = ak.copy(events)
+    # Each region is evaluated once into an index array that is applied only
+    # to the flat columns being filled, the gathered and binned values are
+    # reused by all the variations that do not switch them
+    region_indices = {}
+    bins = {}
 
-    # Fill each histogram
+    # Variations that only switch the weight column are evaluated all at once
+    # as a (nvariations x nevents) weight matrix
+    weight_variations = {}
     for variation_name in variations:
-        events = ak.copy(originalEvents)
+        weight_source = get_weight_source(variations[variation_name])
+        if weight_source is not None:
+            weight_variations[variation_name] = weight_source
+
+    if weight_variations:
+        weights = np.stack(
+            [
+                get_column_numpy(events, weight_source)
+                for weight_source in weight_variations.values()
+            ]
+        )
+
+        for iregion, region_name in enumerate(regions):
+            if not region_variables[region_name]:
+                continue
+            index = get_region_index(events, region_indices, region_name)
+            masked_weights = weights[:, index[1]]
+            masked_components = component_weights[index[1]]
+            rows = []
+            categories = []
+            for icomponent, component_name in enumerate(components):
+                sample_key = f"{sample_name}_{component_name}"
+                component = masked_components[:, icomponent]
+                for irow, variation_name in enumerate(weight_variations):
+                    if sample_key not in variations[variation_name]["samples"]:
+                        continue
+                    rows.append(masked_weights[irow] * component)
+                    categories.append(
+                        (variation_index[variation_name], iregion, icomponent)
+                    )
+            fill_histos(
+                histos,
+                region_variables[region_name],
+                events,
+                rows,
+                categories,
+                index,
+                bins=bins,
+            )
+
+    other_variations = [
+        variation_name
+        for variation_name in variations
+        if variation_name not in weight_variations
+    ]
+
+    # Fill each histogram, switches are applied as a remapping of the columns
+    for variation_name in other_variations:
+        switches = {}
         for switch in variations[variation_name]["switches"]:
             if len(switch) == 2:
                 # print(switch)
                 variation_dest, variation_source = switch
-                events[variation_dest] = events[variation_source]
+                switches[variation_dest] = switches.get(
+                    variation_source, variation_source
+                )
 
-        for region_name in regions:
-            masked_events = events[events[region_name]]
-            for variable_name in variables:
-                for component_name in ak.fields(events.components):
-                    sample_key = f"{sample_name}_{component_name}"
-                    if sample_key not in variations[variation_name]["samples"]:
-                        continue
+        for iregion, region_name in enumerate(regions):
+            if not region_variables[region_name]:
+                continue
+            index = get_region_index(
+                events, region_indices, switches.get(region_name, region_name)
+            )
+            masked_components = component_weights[index[1]]
+            masked_weight = get_column_numpy(
+                events, switches.get("genWeight", "genWeight")
+            )[index[1]]
+            rows = []
+            categories = []
+            for icomponent, component_name in enumerate(components):
+                sample_key = f"{sample_name}_{component_name}"
+                if sample_key not in variations[variation_name]["samples"]:
+                    continue
 
-                    weight = (
-                        masked_events["genWeight"]
-                        * masked_events["components"][component_name]
-                    )
-                    kwargs = {
-                        "variation": variation_name,
-                        "region": region_name,
-                        "component": component_name,
-                        "weight": weight,
-                    }
-
-                    if ":" in variable_name:
-                        variable_name1, variable_name2 = variable_name.split(":")
-                        kwargs[variable_name1] = masked_events[variable_name1]
-                        kwargs[variable_name2] = masked_events[variable_name2]
-                    else:
-                        kwargs[variable_name] = masked_events[variable_name]
-
-                    histos[variable_name].fill(**kwargs)
+                rows.append(masked_weight * masked_components[:, icomponent])
+                categories.append(
+                    (variation_index[variation_name], iregion, icomponent)
+                )
+            fill_histos(
+                histos,
+                region_variables[region_name],
+                events,
+                rows,
+                categories,
+                index,
+                switches,
+                bins,
+            )
+
+    del bins, region_indices
+    del events
+    return nevents, sumw
+
+
+def process(
+    chunk,
+    sample_name,
+    branches,
+    object_definitions,
+    get_variables,
+    # selections,
+    get_regions,
+    get_variations,
+    eft={},
+    stored_only=False,
+    events=None,
+):
+    """
+    Processes a chunk and returns its histograms.
+
+    If "partials_dir" is in chunk the histograms are stored there for each
+    (variable, region) and only the new or changed ones are recomputed.
+
+    Parameters
+    ----------
+    chunk : dict
+        chunk dictionary, see `read_events`
+    sample_name : str
+        name of the sample
+    branches : list
+        list of branches to read
+    object_definitions : function
+        function defining the objects
+    get_variables : function
+        function returning the variables
+    get_regions : function
+        function returning the regions
+    get_variations : function
+        function returning the variations
+    eft : dict, optional
+        dictionary with "ops", "rwgts" and optionally "components" (the subset
+        of components to fill) and "matrix" for eft samples, by default {}
+    stored_only : bool, optional
+        if True do not process the events and return None unless all the
+        histograms of the chunk are already stored and up to date,
+        by default False
+    events : concurrent.futures.Future, optional
+        future of the events already being read, see `prefetch_events`,
+        by default None
+
+    Returns
+    -------
+    dict or None
+        {sample_name: {"nevents": ..., "sumw": ..., "histos": ...}}
+    """
+    variables = get_variables()
+    regions = get_regions()
+    variations = get_variations()
+    if eft:
+        components = eft.get("components")
+        if components is None:
+            components = get_components(eft["ops"], eft["rwgts"])
+    else:
+        components = ["sm"]
+
+    histos = create_histos(variables, len(variations), len(regions), len(components))
+    pairs = [
+        (variable_name, region_name)
+        for variable_name in variables
+        for region_name in regions
+    ]
+
+    # If "partials_dir" is in chunk, the histograms of each (variable, region)
+    # are stored for this chunk together with their fingerprints.
+    # Only new or changed combinations are recomputed
+    partials_path = None
+    partials = {}
+    stored = {}
+    pairs_todo = pairs
+    if chunk.get("partials_dir") is not None:
+        fingerprints = get_pair_fingerprints(variables, regions)
+        chunk_fingerprint = get_chunk_fingerprint(
+            chunk, sample_name, branches, object_definitions, variations, eft
+        )
+        partials_path = get_partials_path(
+            chunk["partials_dir"], sample_name, chunk_fingerprint
+        )
+        partials = load_partials(partials_path)
+        stored = partials.get("histos", {})
+        pairs_todo = [
+            pair
+            for pair in pairs
+            if pair not in stored or stored[pair][0] != fingerprints[pair]
+        ]
+
+    if stored_only and pairs_todo:
+        return None
+
+    if pairs_todo:
+        processed = process_events(
+            chunk,
+            sample_name,
+            branches,
+            object_definitions,
+            variables,
+            regions,
+            variations,
+            components,
+            eft,
+            histos,
+            set(pairs_todo),
+            events,
+        )
+        if processed is None:
+            return {}
+        nevents, sumw = processed
+    else:
+        nevents, sumw = partials["nevents"], partials["sumw"]
+
+    region_index = {name: i for i, name in enumerate(regions)}
+    for variable_name, region_name in pairs:
+        if (variable_name, region_name) in pairs_todo:
+            continue
+        view = histos[variable_name].view(True)
+        view[:, region_index[region_name]] = stored[(variable_name, region_name)][1]
+
+    if partials_path is not None and pairs_todo:
+        partials = {
+            "nevents": nevents,
+            "sumw": sumw,
+            "histos": {
+                (variable_name, region_name): (
+                    fingerprints[(variable_name, region_name)],
+                    histos[variable_name].view(True)[:, region_index[region_name]],
+                )
+                for variable_name, region_name in pairs
+            },
+        }
+        save_partials(partials_path, partials)
+        print(
+            "Recomputed",
+            len(pairs_todo),
+            "out of",
+            len(pairs),
+            "(variable, region) for chunk",
+            chunk_fingerprint,
+        )
 
     result = {
         sample_name: {
@@ -195,6 +737,32 @@ def process(
             "histos": histos,
         }
     }
-    del events
     gc.collect()
     return result
+
+
+def process_chunks(chunks, *args):
+    """
+    Process many chunks one after the other (reading the next one in the
+    background) and sum their results in place
+    with a pairwise tree reduction, to be used inside worker processes so
+    that a single result is returned for all the chunks.
+
+    Parameters
+    ----------
+    chunks : list
+        list of chunk dictionaries, see `read_events`
+    *args
+        the other arguments of `process`
+
+    Returns
+    -------
+    dict
+        the sum of the results of `process` for each chunk
+    """
+    # reads the next chunk while processing the current one
+    results = (
+        process(chunk, *args, events=events)
+        for chunk, events in prefetch_events(chunks, args[1])
+    )
+    return add_dict_iterable(results, tree=True)
@@ -1,26 +1,44 @@
+import argparse
 import concurrent.futures
-import glob
 import os
 import sys
-from math import ceil
 
 import hist
-import numpy as np
-import uproot
 import vector
-from gen_studies.analysis.process import process
+from gen_studies.analysis.index import (
+    get_files_metadata,
+    get_sample_files,
+    load_index,
+    save_index,
+)
+from gen_studies.analysis.output import write_archive, write_histos
+from gen_studies.analysis.process import prefetch_events, process, process_chunks
+from gen_studies.analysis.tracing import get_touched_branches
 from gen_studies.analysis.utils import (
-    add_dict,
-    add_dict_iterable,
-    hist_fold,
-    hist_unroll,
+    add_dict_inplace,
+    array_fold,
+    array_unroll,
+    get_chunks,
+    get_components,
+    get_used_components,
+    read_components_matrix,
     read_ops,
+    reduce_variations,
 )
 
 vector.register_awkward()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Run the analysis of config.py")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the jobs already stored in runner['partials_dir'] "
+        "by a previous (interrupted) run and merge their stored histograms",
+    )
+    args = parser.parse_args()
+
     path = os.path.abspath(".")
     print("Working in analysis path:", path)
     sys.path.insert(0, path)
@@ -37,8 +55,42 @@ def main():
     object_definitions = analysis_dict["object_definitions"]
     runner = analysis_dict["runner"]
     samples = analysis_dict["samples"]
+    plots = analysis_dict.get("plots", None)
+    structures = analysis_dict.get("structures", None)
+
+    # on-disk index of the files of each sample and their metadata
+    files_index_path = runner.get("files_index", "files_index.json")
+    files_index = load_index(files_index_path)
+
+    # options forwarded to each chunk, see read_events and process
+    chunk_options = dict(
+        cache_dir=runner.get("cache_dir", None),
+        partials_dir=runner.get("partials_dir", None),
+        prefetch=runner.get("prefetch", True),
+    )
+
+    # threads used by each worker to read, decompress and interpret the
+    # baskets, by default the available cores are split between the workers
+    if hasattr(os, "sched_getaffinity"):
+        ncores = len(os.sched_getaffinity(0))
+    else:
+        ncores = os.cpu_count() or 1
+    max_workers = runner.get("max_workers", 2)
+    if runner["local"]:
+        num_threads = runner.get("num_threads", ncores)
+    else:
+        num_threads = runner.get("num_threads", max(1, ncores // max_workers))
+    chunk_options["num_threads"] = num_threads
+    chunk_options["open_options"] = dict(num_workers=num_threads)
+    if args.resume and chunk_options["partials_dir"] is None:
+        print(
+            "Can not resume without runner['partials_dir'] in the config",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
     results = {}
+    components = {}
     print("Running analysis")
     for sample_name in samples:
         print(sample_name)
@@ -46,7 +98,6 @@ def main():
         xs = samples[sample_name]["xs"]
         files_pattern = samples[sample_name]["files_pattern"]
         limit_files = samples[sample_name]["limit_files"]
-        nevents_per_file = samples[sample_name]["nevents_per_file"]
         nevents_per_job = samples[sample_name]["nevents_per_job"]
 
         doEft = False
@@ -57,7 +108,7 @@ def main():
             ops = samples[sample_name]["eft"]["ops"]
             _, rwgts = read_ops(reweight_card)
 
-        files = glob.glob(files_pattern)
+        files = get_sample_files(files_index, sample_name, files_pattern)
         files = files[:limit_files]
 
         if len(files) == 0:
@@ -68,15 +119,45 @@ def main():
             )
             sys.exit(1)
 
+        entries = [
+            metadata["entries"] for metadata in get_files_metadata(files_index, files)
+        ]
+        save_index(files_index, files_index_path)
         print("Should process", len(files), "files")
-        print("for a total of", len(files) * nevents_per_file, "events")
-
-        nfiles_per_job = ceil(nevents_per_job / nevents_per_file)
-        njobs = ceil(len(files) / nfiles_per_job)
+        print("for a total of", sum(entries), "events")
+
+        # cached branches are memory mapped, jobs do not span several files
+        # so that they are never concatenated (copied)
+        chunks = get_chunks(
+            files,
+            entries,
+            nevents_per_job,
+            split_files=chunk_options["cache_dir"] is not None,
+        )
+        njobs = len(chunks)
+
+        sample_branches = branches
+        if runner.get("prune_branches", True):
+            # read only the branches touched by the functions of the config
+            variations = get_variations()
+            required = ["genWeight"] + (["LHEReweightingWeight"] if doEft else [])
+            for variation in variations.values():
+                for switch in variation["switches"]:
+                    required.extend(switch)
+            sample_branches = get_touched_branches(
+                files[0],
+                branches,
+                object_definitions,
+                get_variables(),
+                get_regions(),
+                variations,
+                required,
+            )
+            print("Will read branches", ", ".join(sample_branches))
 
         process_args = (
             sample_name,
-            branches,
+            sample_branches,
             object_definitions,
             get_variables,
             get_regions,
@@ -84,44 +165,92 @@ def main():
         )
 
         if doEft:
+            # only build and fill the components used by plots, structures
+            # and shape systematics
+            components[sample_name] = get_used_components(
+                sample_name,
+                get_components(ops, rwgts),
+                plots,
+                structures,
+                systematics,
+            )
             eft = {
                 "rwgts": rwgts,
                 "ops": ops,
+                "components": components[sample_name],
+                "matrix": read_components_matrix(
+                    reweight_card, ops, components[sample_name]
+                ),
             }
         else:
             eft = {}
+            components[sample_name] = ["sm"]
+
+        if args.resume:
+            # merge the jobs completed by a previous run, process the others
+            chunks_todo = []
+            for chunk in chunks:
+                result = process(
+                    dict(chunk, **chunk_options),
+                    *process_args,
+                    eft,
+                    stored_only=True,
+                )
+                if result is None:
+                    chunks_todo.append(chunk)
+                else:
+                    results = add_dict_inplace(results, result)
+            print("Resuming,", njobs - len(chunks_todo), "jobs already done")
+            chunks = chunks_todo
+            njobs = len(chunks)
 
         if runner["local"]:
-            for ijob in range(njobs):
-                start = ijob * nfiles_per_job
-                stop = min((ijob + 1) * nfiles_per_job, len(files))
-                chunk = dict(
-                    files={k: "Events" for k in files[start:stop]},
-                    num_workers=2,
+            # the next chunk is read while processing the current one
+            local_chunks = [dict(chunk, **chunk_options) for chunk in chunks]
+            for ijob, (chunk, events) in enumerate(
+                prefetch_events(local_chunks, sample_branches)
+            ):
+                results = add_dict_inplace(
+                    results, process(chunk, *process_args, eft, events=events)
                 )
-
-                results = add_dict(results, process(chunk, *process_args, eft))
-                print(f"Done {ijob+1}/{njobs}")
+                print(f"Done {ijob + 1}/{njobs}")
         else:
-            with concurrent.futures.ProcessPoolExecutor(
-                runner.get("max_workers", 2)
-            ) as pool:
-                tasks = []
-                for ijob in range(njobs):
-                    start = ijob * nfiles_per_job
-                    stop = min((ijob + 1) * nfiles_per_job, len(files))
-                    chunk = dict(
-                        files={k: "Events" for k in files[start:stop]},
-                        num_workers=1,
+            # each task processes chunks_per_task jobs and sums them in the
+            # worker before sending back the result
+            chunks_per_task = runner.get("chunks_per_task", 1)
+            # keep at most max_in_flight jobs (not tasks) submitted, fold each
+            # result in the accumulator as soon as it arrives
+            max_in_flight = runner.get(
+                "max_in_flight", 2 * max_workers * chunks_per_task
+            )
+            with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+                tasks = {}
+                ijob = 0
+                njobs_done = 0
+                while ijob < njobs or tasks:
+                    while ijob < njobs:
+                        task_chunks = [
+                            dict(chunk, **chunk_options)
+                            for chunk in chunks[ijob : ijob + chunks_per_task]
+                        ]
+                        # always keep one task running, even if it holds
+                        # more than max_in_flight jobs
+                        jobs_in_flight = sum(tasks.values())
+                        if tasks and jobs_in_flight + len(task_chunks) > max_in_flight:
+                            break
+                        ijob += len(task_chunks)
+                        task = pool.submit(
+                            process_chunks, task_chunks, *process_args, eft
+                        )
+                        tasks[task] = len(task_chunks)
+                    done, _ = concurrent.futures.wait(
+                        tasks, return_when=concurrent.futures.FIRST_COMPLETED
                     )
-                    tasks.append(pool.submit(process, chunk, *process_args, eft))
-                print("waiting for tasks")
-                concurrent.futures.wait(tasks)
-                print("tasks completed")
-                results = add_dict(
-                    results,
-                    add_dict_iterable([task.result() for task in tasks]),
-                )
+                    for task in done:
+                        results = add_dict_inplace(results, task.result())
+                        njobs_done += tasks.pop(task)
+                        print(f"Done {njobs_done}/{njobs}")
+                    del done
 
         print(
             "\n\nDone",
@@ -133,10 +262,20 @@ def main():
     variables = get_variables()
     variations = get_variations()
     regions = get_regions()
-    components = {}
 
-    out = uproot.recreate("histos.root")
-    print("Post processing and saving histos")
+    weight_systematics = [
+        systematic
+        for systematic in systematics
+        if systematics[systematic].get("kind", "")
+        in ["weight_envelope", "weight_rms", "weight_square"]
+    ]
+    variation_index = {name: i for i, name in enumerate(variations)}
+
+    # all the histograms are post processed in memory and written once,
+    # replicas consumed by the systematics are not saved
+    histos = {}
+    replicas = set()
+    print("Post processing histos")
     for sample_name in samples:
         print(sample_name)
         xs = samples[sample_name]["xs"]
@@ -145,141 +284,87 @@ def main():
             xs * 1000.0 * lumi / result["sumw"]
         )  # scale histos to xs in fb, multiply by lumi and get number of events
 
-        first_hist = list(result["histos"].values())[0]
-        # Look for components
-        components[sample_name] = [
-            first_hist.axes[-1].value(i)
-            for i in range(len(first_hist.axes[-1].centers))
-        ]
-
+        # histograms are indexed by (variation, region, component)
         for variable_name in variables:
-            for region_name in regions:
-                for component in components[sample_name]:
+            good_variable = variable_name.replace(":", "_")
+            h_variable = result["histos"][variable_name]
+            variable_axes = h_variable.axes[3:]
+            fold = variables[variable_name].get("fold", 3)
+
+            # dense (variation, region, component, bins) post processed values,
+            # scaled to xs, folded and unrolled for all the histograms at once
+            view = h_variable.view(True)
+            values = view.value * scale
+            variances = view.variance * scale * scale
+            array_fold(values, fold, variable_axes)
+            array_fold(variances, fold, variable_axes)
+            if ":" in variable_name:
+                values = array_unroll(values, variable_axes)
+                variances = array_unroll(variances, variable_axes)
+                nbins = values.shape[-1] - 2
+                h_template = hist.Hist(
+                    hist.axis.Regular(nbins, 0, nbins), hist.storage.Weight()
+                )
+            else:
+                h_template = hist.Hist(*variable_axes, hist.storage.Weight())
+
+            for iregion, region_name in enumerate(regions):
+                for icomponent, component in enumerate(components[sample_name]):
                     sample_key = f"{sample_name}_{component}"
-                    for variation_name in variations:
+                    for ivariation, variation_name in enumerate(variations):
                         if sample_key not in variations[variation_name]["samples"]:
                             continue
-                        h_slice = (
-                            hist.loc(variation_name),
-                            hist.loc(region_name),
-                            hist.loc(component),
-                        )
-                        if ":" in variable_name:
-                            h_slice = (
-                                slice(None),
-                                slice(None),
-                            ) + h_slice
-                        else:
-                            h_slice = (slice(None),) + h_slice
-
-                        # print(h_slice)
-                        h = result["histos"][variable_name][h_slice].copy()
-                        # h is now the histogram we will be saving
-                        # will have to scale to xs and fold
-
-                        # scale in place
-                        a = h.view(True)
-                        a.value = a.value * scale
-                        a.variance = a.variance * scale * scale
-
-                        # fold in place
-                        hist_fold(h, variables[variable_name].get("fold", 3))
-
-                        if ":" in variable_name:
-                            # will not unroll in place -> overwrite variable
-                            h = hist_unroll(h)
-                        good_variable = variable_name.replace(":", "_")
+                        h = h_template.copy()
+                        hview = h.view(True)
+                        hview.value = values[ivariation, iregion, icomponent]
+                        hview.variance = variances[ivariation, iregion, icomponent]
                         final_name = f"{region_name}/{good_variable}/"
                         final_name += f"histo_{sample_name}_{component}"
                         if variation_name != "nominal":
                             final_name += f"_{variation_name}"
-                        out[final_name] = h
-        print("Saved components", ", ".join(components[sample_name]))
-    out.close()
-
-    print("Post processing systematics")
-    out = uproot.update("histos.root")
-    for sample_name in samples:
-        for variable_name in variables:
-            for region_name in regions:
-                _out = out[f"{region_name}/{good_variable}/"]
-                for component in components[sample_name]:
-                    for systematic in systematics:
-                        if systematics[systematic].get("kind", "") not in [
-                            "weight_envelope",
-                            "weight_rms",
-                            "weight_square",
-                        ]:
-                            continue
-                        sample_key = f"{sample_name}_{component}"
-                        if sample_key not in systematics[systematic]["samples"]:
-                            continue
-                        histos_to_process = systematics[systematic]["samples"][
-                            sample_key
-                        ]
-                        good_variable = variable_name.replace(":", "_")
-                        final_name = ""
-                        final_name += f"histo_{sample_name}_{component}"
+                        histos[final_name] = h
 
-                        h_nominal = _out[final_name].to_hist().copy()
-                        h_up = h_nominal.copy()
-                        h_do = h_nominal.copy()
-                        _variations = np.empty(
-                            shape=(
-                                len(histos_to_process),
-                                len(h_nominal.axes[0].centers) + 2,
-                            ),
-                            dtype=np.float64,
-                        )
-                        for i, histo_to_process in enumerate(histos_to_process):
-                            _final_name = final_name + f"_{histo_to_process}"
-                            _variations[i, :] = _out[_final_name].values(True)
-                        vnominal = h_nominal.values(True)
-                        if systematics[systematic]["kind"].endswith("envelope"):
-                            arrup = np.max(_variations, axis=0)
-                            arrdo = np.min(_variations, axis=0)
-                        elif systematics[systematic]["kind"].endswith("rms"):
-                            arrnom = np.tile(vnominal, (_variations.shape[0], 1))
-                            arrv = np.sqrt(
-                                np.mean(np.square(_variations - arrnom), axis=0)
-                            )
-                            arrup = vnominal + arrv
-                            arrdo = vnominal - arrv
-                        elif systematics[systematic]["kind"].endswith("square"):
-                            arrnom = np.tile(vnominal, (_variations.shape[0], 1))
-                            arrup = vnominal + np.sum(
-                                np.where(
-                                    _variations >= arrnom,
-                                    np.square(_variations - arrnom),
-                                    0.0,
-                                ),
-                                axis=0,
-                            )
-                            arrdo = vnominal - np.sum(
-                                np.where(
-                                    _variations >= arrnom,
-                                    np.square(_variations - arrnom),
-                                    0.0,
-                                ),
-                                axis=0,
-                            )
-
-                        hview = h_up.view(True)
-                        hview.value = arrup.copy()
-                        hview.variance = arrup.copy()
-
-                        hview = h_do.view(True)
-                        hview.value = arrdo.copy()
-                        hview.variance = arrdo.copy()
-
-                        for histo_to_process in histos_to_process:
-                            _final_name = final_name + f"_{histo_to_process}"
-                            del _out[_final_name]
-
-                        _final_name = final_name + f"_{systematic}Up"
-                        _out[_final_name] = h_up
-                        _final_name = final_name + f"_{systematic}Down"
-                        _out[_final_name] = h_do
+            # each systematic is reduced along the variation axis for all the
+            # regions and the components sharing the same replicas at once
+            for systematic in weight_systematics:
+                groups = {}
+                for icomponent, component in enumerate(components[sample_name]):
+                    sample_key = f"{sample_name}_{component}"
+                    if sample_key not in systematics[systematic]["samples"]:
+                        continue
+                    histos_to_process = systematics[systematic]["samples"][sample_key]
+                    groups.setdefault(tuple(histos_to_process), []).append(icomponent)
+
+                for histos_to_process, icomponents in groups.items():
+                    ireplicas = [variation_index[name] for name in histos_to_process]
+                    arrup, arrdo = reduce_variations(
+                        systematics[systematic]["kind"],
+                        values[variation_index["nominal"]][:, icomponents],
+                        values[ireplicas][:, :, icomponents],
+                    )
+                    for iregion, region_name in enumerate(regions):
+                        for i, icomponent in enumerate(icomponents):
+                            component = components[sample_name][icomponent]
+                            final_name = f"{region_name}/{good_variable}/"
+                            final_name += f"histo_{sample_name}_{component}"
+
+                            for shift, arr in [("Up", arrup), ("Down", arrdo)]:
+                                h = histos[final_name].copy()
+                                hview = h.view(True)
+                                hview.value = arr[iregion, i]
+                                hview.variance = arr[iregion, i]
+                                histos[final_name + f"_{systematic}{shift}"] = h
+
+                            for histo_to_process in histos_to_process:
+                                replicas.add(final_name + f"_{histo_to_process}")
+        print("Post processed components", ", ".join(components[sample_name]))
+
+    print("Saving histos")
+    for final_name in replicas:
+        histos.pop(final_name, None)
+    write_histos("histos.root", histos, runner.get("compression", "ZLIB:1"))
+    if runner.get("archive", None) is not None:
+        write_archive(runner["archive"], histos)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+import awkward as ak
+import uproot
+from gen_studies.analysis.utils import get_variable_keys
+
+
+def form_with_key(form, key):
+    """
+    Returns a copy of form where every node has `form_key=key`, so that
+    touching any buffer of a branch reports the name of the branch.
+    """
+    if hasattr(form, "content"):
+        return form.copy(form_key=key, content=form_with_key(form.content, key))
+    return form.copy(form_key=key)
+
+
+def get_touched_branches(
+    filename,
+    branches,
+    object_definitions,
+    variables,
+    regions,
+    variations,
+    required=[],
+    treename="Events",
+):
+    """
+    Returns the branches actually used by the analysis.
+    The object definitions, the variables, the regions and the variations
+    are run (in the same order as `process_events`) on a typetracer with the
+    form of the tree, which records the branches they touch without reading
+    any data.
+
+    Parameters
+    ----------
+    filename : str
+        root file used to get the form of the branches
+    branches : list
+        list of branches (or patterns) of the config
+    object_definitions : function
+        the object definitions function
+    variables : dict
+        variables dictionary as returned by `get_variables`
+    regions : dict
+        regions dictionary as returned by `get_regions`
+    variations : dict
+        variations dictionary as returned by `get_variations`
+    required : list, optional
+        branches always read (e.g. the weights), by default []
+    treename : str, optional
+        name of the tree, by default "Events"
+
+    Returns
+    -------
+    list
+        list of branches, all the branches matching `branches` if the
+        functions can not be traced
+    """
+    with uproot.open(filename) as file:
+        form = file[treename].arrays(filter_name=branches, entry_stop=0).layout.form
+    form = form.copy(
+        contents=[
+            form_with_key(content, field)
+            for field, content in zip(form.fields, form.contents)
+        ]
+    )
+    layout, report = ak.typetracer.typetracer_with_report(form)
+    events = ak.Array(layout)
+    try:
+        events = object_definitions(events)
+        for variable_name in variables:
+            for column, func_name, _ in get_variable_keys(variable_name):
+                events[column] = variables[variable_name][func_name](events)
+        for region_name in regions:
+            events[region_name] = regions[region_name](events)
+        for variation_name in variations:
+            events = variations[variation_name]["func"](events)
+    except Exception as e:
+        print("Could not trace the branches used, will read all of them:", e)
+        return list(form.fields)
+
+    touched = set(report.data_touched) | set(required)
+    return [branch for branch in form.fields if branch in touched]
@@ -1,4 +1,9 @@
+import contextlib
+import hashlib
 import itertools
+import os
+import pickle
+import shutil
 
 import awkward as ak
 import hist
@@ -29,17 +34,87 @@ def add_dict(d1, d2):
         return d1 + d2
 
 
-def add_dict_iterable(iterable):
+def add_dict_inplace(d1, d2):
+    """
+    Adds `d2` to `d1` accumulating in the storage of `d1` when possible
+    (histograms and nested dictionaries), without allocating new objects.
+
+    Parameters
+    ----------
+    d1 : dict or hist or number
+        the accumulator, will be modified in place
+    d2 : dict or hist or number
+        the object to add, its histograms could be referenced by `d1`
+
+    Returns
+    -------
+    dict or hist or number
+        the accumulator (`d1` itself for dictionaries and histograms)
+    """
+    if isinstance(d1, dict):
+        for key in d2:
+            if key in d1:
+                d1[key] = add_dict_inplace(d1[key], d2[key])
+            else:
+                d1[key] = d2[key]
+        return d1
+    elif isinstance(d1, hist.Hist):
+        d1 += d2
+        return d1
+    else:
+        return add_dict(d1, d2)
+
+
+def add_dict_iterable(iterable, tree=False):
+    """
+    Sums all the elements of an iterable with `add_dict_inplace`.
+    The first element is used as accumulator and is modified in place.
+
+    Parameters
+    ----------
+    iterable : iterable
+        iterable of dictionaries (or histograms, numbers)
+    tree : bool, optional
+        if True use a pairwise tree reduction instead of a linear fold,
+        by default False
+
+    Returns
+    -------
+    dict or hist or number
+        the sum
+    """
+    if tree:
+        # binary counter: merge partial sums of the same size as soon as
+        # they are available, at most log2(n) partials are kept
+        partials = []
+        for it in iterable:
+            size = 1
+            while partials and partials[-1][0] == size:
+                _, previous = partials.pop()
+                it = add_dict_inplace(previous, it)
+                size *= 2
+            partials.append((size, it))
+        tmp = -99999
+        for _, it in reversed(partials):
+            if tmp == -99999:
+                tmp = it
+            else:
+                tmp = add_dict_inplace(it, tmp)
+        return tmp
+
     tmp = -99999
     for it in iterable:
         if tmp == -99999:
             tmp = it
         else:
-            tmp = add_dict(tmp, it)
+            tmp = add_dict_inplace(tmp, it)
     return tmp
 
 
-def read_ops(filename):
+def parse_ops(filename):
+    """
+    Parses a reweight card, see `read_ops`.
+    """
     with open(filename) as file:
         lines = file.read().split("\n")
     lines = list(
@@ -63,42 +138,247 @@ def read_ops(filename):
             ops_val = " ".join(splitted[1:-1])
             # res.append([op, val, rwgt])
             rwgts[ops_val] = irwgt
-    return list(set(ops)), rwgts
+    return list(dict.fromkeys(ops)), rwgts
 
 
-def create_components(events, active_ops, rwgts):
-    weights = events["LHEReweightingWeight"]
-    new_weights = {}
-    new_weights["sm"] = ak.copy(weights[:, rwgts["sm"]])
-    for op in active_ops:
-        # make sm_lin_quad
-        new_weights[f"sm_lin_quad_{op}"] = ak.copy(weights[:, rwgts[f"{op}=1"]])
-        # make linear
-        new_weights[f"lin_{op}"] = 0.5 * (
-            weights[:, rwgts[f"{op}=1"]] - weights[:, rwgts[f"{op}=-1"]]
-        )
-        # make quad
-        new_weights[f"quad_{op}"] = 0.5 * (
-            weights[:, rwgts[f"{op}=1"]]
-            + weights[:, rwgts[f"{op}=-1"]]
-            - 2 * new_weights["sm"]
+@contextlib.contextmanager
+def atomic_path(path):
+    """
+    Writes a file or a directory atomically: yields a temporary path (unique
+    to the process) next to `path` that is moved to `path` when the block
+    completes, so that readers never see a partially written `path`.
+    The temporary path is removed if the block or the move fail, errors are
+    raised.
+
+    Parameters
+    ----------
+    path : str
+        the final path, its directory is created if needed
+
+    Yields
+    ------
+    str
+        the temporary path to write
+
+    Examples
+    --------
+    >>> with atomic_path("files_index.json") as tmp_path:
+    ...     with open(tmp_path, "w") as file:
+    ...         json.dump(index, file)
+    """
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# reweight cards already parsed by this process, see `read_reweight_card`
+_reweight_cards = {}
+
+
+def get_reweight_card_path(filename):
+    """
+    Returns the in-memory key and the on-disk cache file of a reweight card.
+    The key depends on the path, mtime and size of the card, so that a
+    modified card is parsed again.
+    The cache directory is `$GEN_STUDIES_CACHE` if set, otherwise
+    `$XDG_CACHE_HOME/gen_studies` (by default `~/.cache/gen_studies`).
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    cache_dir = os.environ.get(
+        "GEN_STUDIES_CACHE",
+        os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "gen_studies",
+        ),
+    )
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    return key, os.path.join(cache_dir, "reweight_cards", f"{name}.pkl")
+
+
+def save_reweight_card(path, card):
+    # the cache is only an optimization, e.g. a read-only home is not an error
+    try:
+        with atomic_path(path) as tmp_path:
+            with open(tmp_path, "wb") as file:
+                pickle.dump(card, file, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print("Could not cache reweight card in", path, e)
+
+
+def read_reweight_card(filename):
+    """
+    Parses a reweight card once: the result is memoized in memory and in an
+    on-disk cache (see `get_reweight_card_path`) shared by all the processes
+    and entry points that read the same card.
+
+    Parameters
+    ----------
+    filename : str
+        path of the reweight card
+
+    Returns
+    -------
+    dict
+        dictionary with keys "ops" (list of operators), "rwgts" (dictionary
+        of reweight name and index) and "matrices" (dictionary
+        {tuple(active_ops): coefficient matrix}, see `read_components_matrix`)
+    """
+    key, path = get_reweight_card_path(filename)
+    if key in _reweight_cards:
+        return _reweight_cards[key]
+    try:
+        with open(path, "rb") as file:
+            card = pickle.load(file)
+    except Exception:
+        ops, rwgts = parse_ops(filename)
+        card = {"ops": ops, "rwgts": rwgts, "matrices": {}}
+        save_reweight_card(path, card)
+    _reweight_cards[key] = card
+    return card
+
+
+def read_ops(filename):
+    """
+    Reads the operators and the reweights of a reweight card.
+    The card is parsed only if it changed since the last time it was read,
+    see `read_reweight_card`.
+
+    Parameters
+    ----------
+    filename : str
+        path of the reweight card
+
+    Returns
+    -------
+    tuple
+        list of operators and dictionary of reweight name and index
+    """
+    card = read_reweight_card(filename)
+    return list(card["ops"]), dict(card["rwgts"])
+
+
+def read_components_matrix(filename, active_ops, components=None):
+    """
+    Returns the coefficient matrix of the components of the active operators
+    (see `get_components_matrix`) of a reweight card, cached together with
+    the parsed card.
+
+    Parameters
+    ----------
+    filename : str
+        path of the reweight card
+    active_ops : list
+        list of active operators
+    components : list, optional
+        subset of the components, by default all of them
+
+    Returns
+    -------
+    np.ndarray
+        matrix of shape (ncomponents, nrwgts)
+    """
+    card = read_reweight_card(filename)
+    matrix_key = (tuple(active_ops), None if components is None else tuple(components))
+    if matrix_key not in card["matrices"]:
+        card["matrices"][matrix_key] = get_components_matrix(
+            active_ops, card["rwgts"], components
         )
+        save_reweight_card(get_reweight_card_path(filename)[1], card)
+    return card["matrices"][matrix_key]
+
+
+def get_components_matrix(active_ops, rwgts, components=None):
+    """
+    Builds the coefficient matrix that gives each component as a linear
+    combination of the reweighting weights.
+
+    Parameters
+    ----------
+    active_ops : list
+        list of active operators
+    rwgts : dict
+        dictionary of reweight name and index as returned by `read_ops`
+    components : list, optional
+        subset of the components (rows) to build, by default all of them
+
+    Returns
+    -------
+    np.ndarray
+        matrix of shape (ncomponents, nrwgts), components are ordered as in
+        `components` or as in `get_components`
+    """
+    all_components = get_components(active_ops, rwgts)
+    matrix = np.zeros((len(all_components), max(rwgts.values()) + 1))
+
+    def set_row(component, coefficients):
+        for rwgt_key, coefficient in coefficients.items():
+            matrix[all_components.index(component), rwgts[rwgt_key]] += coefficient
+
+    set_row("sm", {"sm": 1.0})
+    for op in active_ops:
+        set_row(f"sm_lin_quad_{op}", {f"{op}=1": 1.0})
+        # lin = 0.5 * (w(op=1) - w(op=-1))
+        set_row(f"lin_{op}", {f"{op}=1": 0.5, f"{op}=-1": -0.5})
+        # quad = 0.5 * (w(op=1) + w(op=-1) - 2 * sm)
+        set_row(f"quad_{op}", {f"{op}=1": 0.5, f"{op}=-1": 0.5, "sm": -1.0})
     for op1, op2 in list(itertools.combinations(active_ops, 2)):
         _op1, _op2 = op1, op2
         rwgt_key = f"{op1}=1, {op2}=1"
         if rwgt_key not in rwgts:
             rwgt_key = f"{op2}=1, {op1}=1"
             _op1, _op2 = op2, op1
-        new_weights[f"mixed_{_op1}_{_op2}"] = (
-            weights[:, rwgts[rwgt_key]]
-            - new_weights["sm"]
-            - new_weights[f"lin_{op1}"]
-            - new_weights[f"quad_{op1}"]
-            - new_weights[f"lin_{op2}"]
-            - new_weights[f"quad_{op2}"]
+        # mixed = w(op1=1, op2=1) - sm - lin_op1 - quad_op1 - lin_op2 - quad_op2
+        #       = w(op1=1, op2=1) - w(op1=1) - w(op2=1) + sm
+        set_row(
+            f"mixed_{_op1}_{_op2}",
+            {rwgt_key: 1.0, f"{op1}=1": -1.0, f"{op2}=1": -1.0, "sm": 1.0},
         )
-        new_weights[f"sm_lin_quad_mixed_{_op1}_{_op2}"] = weights[:, rwgts[rwgt_key]]
-    events["components"] = ak.zip(new_weights)
+        set_row(f"sm_lin_quad_mixed_{_op1}_{_op2}", {rwgt_key: 1.0})
+    if components is not None:
+        matrix = matrix[[all_components.index(component) for component in components]]
+    return matrix
+
+
+def create_components(events, active_ops, rwgts, matrix=None):
+    """
+    Computes the weights of the eft components with a single matrix
+    product between the (nevents, nrwgts) reweighting weights and the
+    coefficient matrix from `get_components_matrix`.
+    The (nevents, ncomponents) array is stored in `events["components"]`,
+    components are ordered as the rows of the matrix (by default as in
+    `get_components`).
+
+    Parameters
+    ----------
+    events : ak.Array
+        events with the LHEReweightingWeight branch
+    active_ops : list
+        list of active operators
+    rwgts : dict
+        dictionary of reweight name and index as returned by `read_ops`
+    matrix : np.ndarray, optional
+        the coefficient matrix (e.g. from `read_components_matrix`), by default
+        built from `active_ops` and `rwgts`
+
+    Returns
+    -------
+    ak.Array
+        the events with the new "components" column
+    """
+    weights = ak.to_numpy(ak.to_regular(events["LHEReweightingWeight"], axis=1))
+    if matrix is None:
+        matrix = get_components_matrix(active_ops, rwgts)
+    events["components"] = weights[:, : matrix.shape[1]].astype(np.float64) @ matrix.T
     return events
 
 
@@ -122,7 +402,54 @@ def get_components(active_ops, rwgts):
     return components
 
 
-def flatten_samples(samples):
+def get_used_components(
+    sample_name, components, plots=None, structures=None, systematics=None
+):
+    """
+    Returns the components of a sample that are consumed downstream: the ones
+    referenced (as `{sample_name}_{component}`) by the plots, the structures
+    or the shape systematics. lnN systematics do not need any histogram and
+    are not considered.
+    If neither plots nor structures are given all the components are used.
+
+    Parameters
+    ----------
+    sample_name : str
+        name of the sample
+    components : list
+        all the components of the sample, see `get_components`
+    plots : dict, optional
+        plots dictionary of the config, by default None
+    structures : dict, optional
+        structures dictionary of the config, by default None
+    systematics : dict, optional
+        systematics dictionary of the config, by default None
+
+    Returns
+    -------
+    list
+        the used components, in the same order as `components`
+    """
+    if plots is None and structures is None:
+        return list(components)
+    sample_keys = set()
+    for plot in (plots or {}).values():
+        sample_keys.update(plot)
+    for structure in (structures or {}).values():
+        sample_keys.update(structure)
+    for systematic in (systematics or {}).values():
+        if systematic.get("type") == "shape":
+            sample_keys.update(systematic["samples"])
+    return [
+        component
+        for component in components
+        if f"{sample_name}_{component}" in sample_keys
+    ]
+
+
+def flatten_samples(samples, plots=None, structures=None, systematics=None):
+    # with plots or structures only the components produced by the analysis
+    # are returned, see get_used_components
     samples_flat = []
     for sample_name in samples:
         if samples[sample_name]["eft"] != {}:
@@ -131,6 +458,9 @@ def flatten_samples(samples):
                 samples[sample_name]["eft"]["ops"],
                 rwgts,
             )
+            components = get_used_components(
+                sample_name, components, plots, structures, systematics
+            )
             for component in components:
                 samples_flat.append(f"{sample_name}_{component}")
         else:
@@ -138,6 +468,338 @@ def flatten_samples(samples):
     return samples_flat
 
 
+def get_chunks(files, entries, nevents_per_job, treename="Events", split_files=False):
+    """
+    Partitions the entries of many files in balanced entry ranges.
+    The number of jobs is `ceil(sum(entries) / nevents_per_job)` and each
+    job gets the same number of entries (up to one), splitting large
+    files across jobs and concatenating small files in the same job.
+    With `split_files` the jobs never span several files: each file is
+    partitioned on its own, so that each job reads a single range (e.g. to
+    use the memory-mapped cached branches without concatenating them).
+
+    Parameters
+    ----------
+    files : list
+        list of root files
+    entries : list
+        number of entries of each file
+    nevents_per_job : int
+        max number of entries for each job
+    treename : str, optional
+        name of the tree, by default "Events"
+    split_files : bool, optional
+        if True each job reads a single file, by default False
+
+    Returns
+    -------
+    list
+        list of chunks (see `read_events`), using the "file" key when the
+        job reads a single file and "ranges" otherwise
+    """
+    if split_files:
+        chunks = []
+        for filename, nentries in zip(files, entries):
+            if nentries > 0:
+                chunks.extend(
+                    get_chunks([filename], [nentries], nevents_per_job, treename)
+                )
+        return chunks
+
+    total = sum(entries)
+    njobs = max(1, -(-total // nevents_per_job))
+    boundaries = [total * ijob // njobs for ijob in range(njobs + 1)]
+    offsets = np.cumsum([0] + list(entries))
+
+    chunks = []
+    for job_start, job_stop in zip(boundaries[:-1], boundaries[1:]):
+        ranges = []
+        for ifile, filename in enumerate(files):
+            start = max(job_start, offsets[ifile])
+            stop = min(job_stop, offsets[ifile + 1])
+            if start >= stop:
+                continue
+            ranges.append(
+                {
+                    "file": filename,
+                    "start": int(start - offsets[ifile]),
+                    "stop": int(stop - offsets[ifile]),
+                }
+            )
+        if len(ranges) == 1:
+            chunks.append(dict(tree=treename, **ranges[0]))
+        else:
+            chunks.append(dict(tree=treename, ranges=ranges))
+    return chunks
+
+
+def reduce_variations(kind, nominal, variations):
+    """
+    Computes the up and down shapes of a systematic from its replicas with
+    a single vectorized operation along the first axis of `variations`.
+    Any number of leading axes (e.g. regions and components) can be
+    processed at once.
+
+    Parameters
+    ----------
+    kind : str
+        kind of the systematic, "weight_envelope", "weight_rms" or
+        "weight_square"
+    nominal : np.ndarray
+        nominal values of shape (..., nbins)
+    variations : np.ndarray
+        values of the replicas of shape (nreplicas, ..., nbins)
+
+    Returns
+    -------
+    tuple
+        up and down values, both with the same shape as `nominal`
+    """
+    if kind.endswith("envelope"):
+        return np.max(variations, axis=0), np.min(variations, axis=0)
+    elif kind.endswith("rms"):
+        delta = np.sqrt(np.mean(np.square(variations - nominal), axis=0))
+    elif kind.endswith("square"):
+        delta = np.sum(
+            np.where(
+                variations >= nominal,
+                np.square(variations - nominal),
+                0.0,
+            ),
+            axis=0,
+        )
+    else:
+        raise Exception("Unknown kind of systematic", kind)
+    return nominal + delta, nominal - delta
+
+
+def get_weight_source(variation, weight_name="genWeight"):
+    """
+    Returns the column used as weight by a variation that only switches the
+    weight column, `None` otherwise.
+
+    Parameters
+    ----------
+    variation : dict
+        variation dictionary as returned by `get_variations`
+    weight_name : str, optional
+        name of the weight column, by default "genWeight"
+
+    Returns
+    -------
+    str or None
+        the name of the column to use as weight (`weight_name` for variations
+        without switches) or None if the variation switches other columns
+    """
+    weight_source = weight_name
+    for switch in variation["switches"]:
+        if len(switch) != 2:
+            continue
+        variation_dest, variation_source = switch
+        if variation_dest != weight_name:
+            return None
+        weight_source = variation_source
+    return weight_source
+
+
+def get_variable_keys(variable_name):
+    """
+    Returns the columns of a variable and the keys of their function and
+    axis in the variable dictionary.
+    Multi-dimensional variables are named "x:y" (or "x:y:z") and define
+    "func1", "axis1", "func2", "axis2", ..., the others "func" and "axis".
+
+    Parameters
+    ----------
+    variable_name : str
+        name of the variable
+
+    Returns
+    -------
+    list
+        list of tuples (column, func key, axis key), one for each dimension
+    """
+    if ":" in variable_name:
+        return [
+            (column, f"func{i}", f"axis{i}")
+            for i, column in enumerate(variable_name.split(":"), start=1)
+        ]
+    return [(variable_name, "func", "axis")]
+
+
+def hist_bin_index(axes, values):
+    """
+    Computes the flat bin index (including under/overflow) of each entry
+    for the given axes.
+
+    Parameters
+    ----------
+    axes : list
+        list of hist axes
+    values : list
+        list of numpy arrays, one for each axis
+
+    Returns
+    -------
+    np.ndarray
+        flat index in the flattened flow view of the axes, -1 for entries
+        that would not be filled (out of range for axes without flow bins)
+    """
+    index = np.zeros(len(values[0]), dtype=np.int64)
+    valid = np.ones(len(values[0]), dtype=bool)
+    for axis, value in zip(axes, values):
+        axis_index = np.asarray(axis.index(value), dtype=np.int64)
+        valid &= (axis_index >= 0) | axis.traits.underflow
+        valid &= (axis_index < len(axis)) | axis.traits.overflow
+        if axis.traits.underflow:
+            axis_index = axis_index + 1
+        index = index * axis.extent + axis_index
+    index[~valid] = -1
+    return index
+
+
+def hist_fill_weights(h, index, weights, categories):
+    """
+    Fills a histogram for many sets of weights sharing the same bin index.
+    The histogram must have one integer category axis for each element of
+    the tuples in `categories` first and then the variable axes.
+    Modifies in place the histogram.
+
+    Parameters
+    ----------
+    h : hist
+        Histogram with Weight storage
+    index : np.ndarray
+        flat bin index of each entry as returned by `hist_bin_index`
+    weights : np.ndarray
+        array of shape (len(categories), len(index)) with the weights
+    categories : list
+        list of tuples with the category indices of each row of `weights`
+    """
+    ncategories = len(categories[0])
+    shape = tuple(axis.extent for axis in h.axes[ncategories:])
+    nbins = int(np.prod(shape))
+
+    valid = index >= 0
+    index = index[valid]
+    weights = weights[:, valid]
+
+    nrows = len(categories)
+    flat_index = (np.arange(nrows)[:, None] * nbins + index[None, :]).ravel()
+    sumw = np.bincount(flat_index, weights.ravel(), minlength=nrows * nbins)
+    sumw2 = np.bincount(flat_index, np.square(weights).ravel(), minlength=nrows * nbins)
+    sumw = sumw.reshape((nrows,) + shape)
+    sumw2 = sumw2.reshape((nrows,) + shape)
+
+    view = h.view(True)
+    for irow, category in enumerate(categories):
+        view_slice = view[tuple(category)]
+        view_slice["value"] += sumw[irow]
+        view_slice["variance"] += sumw2[irow]
+
+
+def hist_flow_slice(axes):
+    """
+    Returns the index that selects the bins without under/overflow along
+    the given axes (the last axes of the indexed array).
+
+    Parameters
+    ----------
+    axes : list
+        list of hist axes
+
+    Returns
+    -------
+    tuple
+        index of the bins without under/overflow
+    """
+    return (...,) + tuple(
+        slice(
+            1 if axis.traits.underflow else 0,
+            -1 if axis.traits.overflow else None,
+        )
+        for axis in axes
+    )
+
+
+def array_move_content(array, ifrom, ito, dims):
+    """
+    Moves the content of the `ifrom` bin to the `ito` bin along each of the
+    axes `dims` of an array, one axis after the other.
+    The other axes are stacked histograms (e.g. variations, regions and
+    components), all moved with the same operation.
+    Modifies in place the array.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        array with the bins of the histograms
+    ifrom : int
+        the index of the bin where content will be reset
+    ito : int
+        the index of the bin where content will be the sum
+    dims : list
+        the axes of the array along which the content is moved
+    """
+    for dim in dims:
+        index_from = [slice(None)] * array.ndim
+        index_to = [slice(None)] * array.ndim
+        index_from[dim] = ifrom
+        index_to[dim] = ito
+        array[tuple(index_to)] += array[tuple(index_from)]
+        array[tuple(index_from)] = 0.0
+
+
+def array_fold(array, fold_method, axes):
+    """
+    Folds stacked histograms, see `hist_fold`.
+    The underflow (overflow) is folded only along the axes that have it.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        array of shape (..., *bins) with the bins of the histograms
+        including under/overflow, will be modified in place
+    fold_method : int
+        see `hist_fold`
+    axes : list
+        the hist axes of the histograms, the last axes of `array`
+    """
+    offset = array.ndim - len(axes)
+    if fold_method == 1 or fold_method == 3:
+        dims = [offset + i for i, axis in enumerate(axes) if axis.traits.underflow]
+        array_move_content(array, 0, 1, dims)
+    if fold_method == 2 or fold_method == 3:
+        dims = [offset + i for i, axis in enumerate(axes) if axis.traits.overflow]
+        array_move_content(array, -1, -2, dims)
+
+
+def array_unroll(array, axes):
+    """
+    Unrolls stacked n-dimensional histograms in 1-dimensional ones.
+    The under/overflow of the original axes are dropped, the unrolled
+    histograms have empty under/overflow.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        array of shape (..., *bins) with the bins of the histograms
+        including under/overflow
+    axes : list
+        the hist axes of the histograms, the last axes of `array`
+
+    Returns
+    -------
+    np.ndarray
+        array of shape (..., prod(bins without flow) + 2)
+    """
+    leading = array.shape[: array.ndim - len(axes)]
+    inner = array[hist_flow_slice(axes)]
+    unrolled = np.zeros(leading + (int(np.prod(inner.shape[len(leading) :])) + 2,))
+    unrolled[..., 1:-1] = inner.reshape(leading + (-1,))
+    return unrolled
+
+
 def hist_move_content(h, ifrom, ito):
     """
     Moves content of a histogram from `ifrom` bin to `ito` bin.
@@ -155,45 +817,11 @@ def hist_move_content(h, ifrom, ito):
     ito : int
         the index of the bin where content will be the sum
     """
-    dimension = len(h.axes)
     # numpy view is a numpy array containing two keys, value
     # and variances for each bin
     numpy_view = h.view(True)
-    content = numpy_view.value
-    sumw2 = numpy_view.variance
-
-    if dimension == 1:
-        content[ito] += content[ifrom]
-        content[ifrom] = 0.0
-
-        sumw2[ito] += sumw2[ifrom]
-        sumw2[ifrom] = 0.0
-
-    elif dimension == 2:
-        content[ito, :] += content[ifrom, :]
-        content[ifrom, :] = 0.0
-        content[:, ito] += content[:, ifrom]
-        content[:, ifrom] = 0.0
-
-        sumw2[ito, :] += sumw2[ifrom, :]
-        sumw2[ifrom, :] = 0.0
-        sumw2[:, ito] += sumw2[:, ifrom]
-        sumw2[:, ifrom] = 0.0
-
-    elif dimension == 3:
-        content[ito, :, :] += content[ifrom, :, :]
-        content[ifrom, :, :] = 0.0
-        content[:, ito, :] += content[:, ifrom, :]
-        content[:, ifrom, :] = 0.0
-        content[:, :, ito] += content[:, :, ifrom]
-        content[:, :, ifrom] = 0.0
-
-        sumw2[ito, :, :] += sumw2[ifrom, :, :]
-        sumw2[ifrom, :, :] = 0.0
-        sumw2[:, ito, :] += sumw2[:, ifrom, :]
-        sumw2[:, ifrom, :] = 0.0
-        sumw2[:, :, ito] += sumw2[:, :, ifrom]
-        sumw2[:, :, ifrom] = 0.0
+    array_move_content(numpy_view.value, ifrom, ito, range(len(h.axes)))
+    array_move_content(numpy_view.variance, ifrom, ito, range(len(h.axes)))
 
 
 def hist_fold(h, fold_method):
@@ -210,10 +838,9 @@ def hist_fold(h, fold_method):
         choices 2: fold overflow
         choices 3: fold both underflow and overflow
     """
-    if fold_method == 1 or fold_method == 3:
-        hist_move_content(h, 0, 1)
-    if fold_method == 2 or fold_method == 3:
-        hist_move_content(h, -1, -2)
+    numpy_view = h.view(True)
+    array_fold(numpy_view.value, fold_method, h.axes)
+    array_fold(numpy_view.variance, fold_method, h.axes)
 
 
 def hist_unroll(h):
@@ -230,21 +857,12 @@ def hist_unroll(h):
     hist
         Unrolled 1-dimensional histogram
     """
-    dimension = len(h.axes)
-    if dimension != 2:
-        raise Exception(
-            "Error in hist_unroll: can only unroll 2D histograms, while got ",
-            dimension,
-            "dimensions",
-        )
-
-    numpy_view = h.view()  # no under/overflow!
-    nx = numpy_view.shape[0]
-    ny = numpy_view.shape[1]
-    h_unroll = hist.Hist(hist.axis.Regular(nx * ny, 0, nx * ny), hist.storage.Weight())
+    numpy_view = h.view(True)
+    nbins = int(np.prod([len(axis) for axis in h.axes]))
+    h_unroll = hist.Hist(hist.axis.Regular(nbins, 0, nbins), hist.storage.Weight())
 
-    numpy_view_unroll = h_unroll.view()
-    numpy_view_unroll.value = numpy_view.value.flatten()
-    numpy_view_unroll.variance = numpy_view.variance.flatten()
+    numpy_view_unroll = h_unroll.view(True)
+    numpy_view_unroll.value = array_unroll(numpy_view.value, h.axes)
+    numpy_view_unroll.variance = array_unroll(numpy_view.variance, h.axes)
 
     return h_unroll
@@ -4,6 +4,7 @@ from typing import OrderedDict
 
 import awkward as ak
 import hist
+from gen_studies.analysis.kernels import split_particles
 from gen_studies.analysis.utils import flatten_samples, read_ops
 from gen_studies.plot.utils import cmap
 
@@ -56,52 +57,37 @@ def object_definitions(events):
         with_name="Momentum4D",
     )
     Particle = Particle[Particle.status == 1]
-    events["Particle"] = Particle
+
+    # Split the particles by pdgId in a single compiled pass
+    # Jets are everything that is not Lepton, Neutrino or Higgs
+    collections = split_particles(
+        Particle,
+        {"Neutrino": [12, 14, 16], "Lepton": [11, 13], "Tau": [15], "Higgs": [25]},
+        default="Jet",
+    )
 
     # Define MET
-    neutrinos_gen = events.Particle[
-        (
-            (abs(events.Particle.pdgId) == 12)
-            | (abs(events.Particle.pdgId) == 14)
-            | (abs(events.Particle.pdgId) == 16)
-        )
-    ]
-    # events["MET"] = neutrinos_gen[:, 0] + neutrinos_gen[:, 1]
-    events["MET"] = ak.sum(neutrinos_gen, axis=1)
-
-    # Remove neutrinos from particle
-    events["Particle"] = events.Particle[
-        (
-            (abs(events.Particle.pdgId) != 12)
-            & (abs(events.Particle.pdgId) != 14)
-            & (abs(events.Particle.pdgId) != 16)
-        )
-    ]
+    events["MET"] = ak.sum(collections["Neutrino"], axis=1)
 
     # Define leptons no tau
-    events["Lepton"] = events.Particle[
-        (abs(events.Particle.pdgId) == 11) | (abs(events.Particle.pdgId) == 13)
-    ]
-    # Remove events where nleptons != 2
-    events = events[ak.num(events.Lepton) == 2]
+    events["Lepton"] = collections["Lepton"]
 
     # Define Higgs
-    events["Higgs"] = events.Particle[events.Particle.pdgId == 25]
+    events["Higgs"] = collections["Higgs"]
 
     # Define Jets
-    # Everything that is not Lepton or Neutrino
-    # Or Higgs
-    events["Jet"] = events.Particle[
-        (
-            (abs(events.Particle.pdgId) != 11)
-            & (abs(events.Particle.pdgId) != 12)
-            & (abs(events.Particle.pdgId) != 13)
-            & (abs(events.Particle.pdgId) != 14)
-            & (abs(events.Particle.pdgId) != 15)
-            & (abs(events.Particle.pdgId) != 16)
-            & (abs(events.Particle.pdgId) != 25)
-        )
-    ]
+    events["Jet"] = collections["Jet"]
+
+    # Remove events where nleptons != 2
+    events = events[ak.num(events.Lepton) == 2]
+
+    # Leading objects and pairs, computed once and shared by variables and regions
+    events["Jet1"] = events.Jet[:, 0]
+    events["Jet2"] = events.Jet[:, 1]
+    events["jj"] = events.Jet1 + events.Jet2
+    events["Higgs1"] = events.Higgs[:, 0]
+    events["Higgs2"] = events.Higgs[:, 1]
+    events["hh"] = events.Higgs1 + events.Higgs2
 
     return events
 
@@ -109,29 +95,29 @@ def object_definitions(events):
 def get_variables():
     return {
         "mjj": {
-            "func": lambda events: (events.Jet[:, 0] + events.Jet[:, 1]).mass,
+            "func": lambda events: events.jj.mass,
             "axis": hist.axis.Regular(50, 250, 3500, name="mjj"),
             "formatted": r"m_{jj} \; [GeV]",
         },
         "mhh:pth1": {
-            "func1": lambda events: (events.Higgs[:, 0] + events.Higgs[:, 1]).mass,
+            "func1": lambda events: events.hh.mass,
             "axis1": hist.axis.Regular(10, 200, 3000, name="mhh"),
-            "func2": lambda events: events.Higgs[:, 0].pt,
+            "func2": lambda events: events.Higgs1.pt,
             "axis2": hist.axis.Regular(6, 30, 150, name="pth1"),
             "formatted": "m_{hh}:p^T_{h1}",
         },
         "detajj": {
-            "func": lambda events: abs(events.Jet[:, 0].deltaeta(events.Jet[:, 1])),
+            "func": lambda events: abs(events.Jet1.deltaeta(events.Jet2)),
             "axis": hist.axis.Regular(25, 1, 8, name="detajj"),
             "formatted": r"\Delta\eta_{jj}",
         },
         "ptj1": {
-            "func": lambda events: events.Jet[:, 0].pt,
+            "func": lambda events: events.Jet1.pt,
             "axis": hist.axis.Regular(30, 30, 150, name="ptj1"),
             "formatted": r"p^T_{j1} \; [GeV]",
         },
         "ptj2": {
-            "func": lambda events: events.Jet[:, 1].pt,
+            "func": lambda events: events.Jet2.pt,
             "axis": hist.axis.Regular(30, 30, 150, name="ptj2"),
             "formatted": r"p^T_{j2} \; [GeV]",
         },
@@ -141,13 +127,13 @@ def get_variables():
 def get_regions():
     def sr(events):
         return (
-            ((events.Jet[:, 0].pt > 30.0) & (events.Jet[:, 1].pt > 30.0))
+            ((events.Jet1.pt > 30.0) & (events.Jet2.pt > 30.0))
             & (abs(events.detajj) >= 2.5)
             & (events.mjj >= 150)  # can also use defined variables!
             & (events.ptj1 >= 30)
             & (events.ptj2 >= 30)
-            & (abs(events.Jet[:, 0].eta) < 5)
-            & (abs(events.Jet[:, 1].eta) < 5)
+            & (abs(events.Jet1.eta) < 5)
+            & (abs(events.Jet2.eta) < 5)
         )
 
     return {
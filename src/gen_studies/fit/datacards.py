@@ -2,7 +2,7 @@ import concurrent.futures  # noqa: F401
 import os
 import sys
 
-import uproot
+from gen_studies.analysis.output import open_histos
 from gen_studies.fit.utils import make_datacard
 
 
@@ -18,12 +18,13 @@ def main():
     get_regions = analysis_dict["get_regions"]
     get_variables = analysis_dict["get_variables"]
     systematics = analysis_dict["systematics"]
+    runner = analysis_dict["runner"]
     structures = analysis_dict["structures"]
 
     variables = get_variables()
     regions = get_regions()
 
-    input_file = uproot.open("histos.root")
+    input_file = open_histos("histos.root", runner.get("archive", None))
 
     os.makedirs("datacards", exist_ok=True)
 
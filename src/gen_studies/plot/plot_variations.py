@@ -3,7 +3,7 @@ import sys
 
 import matplotlib as mpl
 import numpy as np
-import uproot
+from gen_studies.analysis.output import open_histos
 from gen_studies.analysis.utils import flatten_samples
 
 mpl.use("Agg")
@@ -51,6 +51,7 @@ def main():
     get_regions = analysis_dict["get_regions"]
     get_variables = analysis_dict["get_variables"]
     systematics = analysis_dict["systematics"]
+    runner = analysis_dict["runner"]
 
     lumi = analysis_dict["lumi"]
     plot_label = analysis_dict["plot_label"]
@@ -60,9 +61,14 @@ def main():
 
     os.makedirs("plots_variations", exist_ok=True)
 
-    file = uproot.open("histos.root")
+    file = open_histos("histos.root", runner.get("archive", None))
 
-    flat_samples = flatten_samples(samples)
+    flat_samples = flatten_samples(
+        samples,
+        analysis_dict.get("plots", None),
+        analysis_dict.get("structures", None),
+        systematics,
+    )
     for region in regions:
         for variable in variables:
             if "formatted" in variables[variable]:
@@ -2,7 +2,7 @@ import concurrent.futures
 import os
 import sys
 
-import uproot
+from gen_studies.analysis.output import open_histos
 from gen_studies.plot.utils import final_bkg_plot
 
 
@@ -19,6 +19,7 @@ def main():
     get_regions = analysis_dict["get_regions"]
     get_variables = analysis_dict["get_variables"]
     systematics = analysis_dict["systematics"]
+    runner = analysis_dict["runner"]
 
     plots = analysis_dict["plots"]
     scales = analysis_dict["scales"]
@@ -29,7 +30,7 @@ def main():
     variables = get_variables()
     regions = get_regions()
 
-    input_file = uproot.open("histos.root")
+    input_file = open_histos("histos.root", runner.get("archive", None))
 
     os.makedirs("plots", exist_ok=True)
 
@@ -355,7 +355,7 @@ def final_bkg_plot(
         if not isSignal:
             continue
         label = plot_dict[sample_name]["name"]
-        h_sm = input_file[region][variable][f"histo_{sample_name}"].to_hist().copy()
+        h_sm = input_file[f"{region}/{variable}/histo_{sample_name}"].to_hist().copy()
         color = plot_dict[sample_name].get("color", "black")
         plot_ratio_single_err(
             h_sm,